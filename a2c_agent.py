@@ -8,6 +8,8 @@ import torch.nn.functional as F
 import botbowl
 from botbowl.ai.env import EnvConf, BotBowlEnv
 from implementation.a2c.a2c_env import a2c_scripted_actions
+from implementation.action_queue import ActionQueue
+from implementation.model_registry import model_registry
 from botbowl.ai.layers import *
 
 model_name = 'long'
@@ -17,6 +19,9 @@ model_filename = f"models/{env_name}/{model_name}.nn"
 model_filename_opponent = f"models/{env_name}/{model_name_opponent}.nn"
 log_filename = f"logs/{env_name}/{env_name}.dat"
 num_games = 1000
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+cpu_threads = None
+trace_cpu_policy = False
 
 
 class CNNPolicy(nn.Module):
@@ -43,13 +48,17 @@ class CNNPolicy(nn.Module):
         self.actor.weight.data.mul_(relu_gain)
         self.critic.weight.data.mul_(relu_gain)
 
+    @property
+    def device(self):
+        return self.actor.weight.device
+
     def forward(self, spatial_input, non_spatial_input):
-        x1 = self.conv1(spatial_input.cuda())
+        x1 = self.conv1(spatial_input.to(self.device))
         x1 = F.relu(x1)
         x1 = self.conv2(x1)
         x1 = F.relu(x1)
         flatten_x1 = x1.flatten(start_dim=1)
-        x2 = self.linear0(non_spatial_input.cuda())
+        x2 = self.linear0(non_spatial_input.to(self.device))
         x2 = F.relu(x2)
         flatten_x2 = x2.flatten(start_dim=1)
         concatenated = torch.cat((flatten_x1, flatten_x2), dim=1)
@@ -60,15 +69,17 @@ class CNNPolicy(nn.Module):
         return value, actor
 
     def act(self, spatial_inputs, non_spatial_input, action_mask):
-        values, action_probs = self.get_action_probs(spatial_inputs, non_spatial_input, action_mask=action_mask)
-        actions = action_probs.multinomial(1)
-        for i, action in enumerate(actions):
-            i = torch.tensor(i, dtype=torch.long, device=action.device)
-            correct_action = action
-            while not action_mask[i][action]:
-                correct_action = action_probs[i].multinomial(1)
-            actions[i] = correct_action
-        return values, actions
+        values, actions = self(spatial_inputs, non_spatial_input)
+        return values, CNNPolicy.sample_actions(actions, action_mask)
+
+    def act_with_log_probs(self, spatial_inputs, non_spatial_input, action_mask):
+        """
+        Like act, but also returns the log probabilities of the sampled actions under the masked policy.
+        """
+        values, actions = self(spatial_inputs, non_spatial_input)
+        sampled = CNNPolicy.sample_actions(actions, action_mask)
+        log_probs = F.log_softmax(actions.masked_fill(~action_mask.to(actions.device), float('-inf')), dim=1)
+        return values, sampled, log_probs.gather(1, sampled)
 
     def evaluate_actions(self, spatial_inputs, non_spatial_input, actions, actions_mask):
         value, policy = self(spatial_inputs, non_spatial_input)
@@ -83,10 +94,22 @@ class CNNPolicy(nn.Module):
 
     def get_action_probs(self, spatial_input, non_spatial_input, action_mask):
         values, actions = self(spatial_input, non_spatial_input)
+        return values, CNNPolicy.mask_action_probs(actions, action_mask)
+
+    @staticmethod
+    def mask_action_probs(actions, action_mask):
         if action_mask is not None:
-            actions[~action_mask] = float('-inf')
-        action_probs = F.softmax(actions, dim=1)
-        return values, action_probs
+            actions[~action_mask.to(actions.device)] = float('-inf')
+        return F.softmax(actions, dim=1)
+
+    @staticmethod
+    def sample_actions(actions, action_mask):
+        # Gumbel-max sampling from the masked softmax for the whole batch at once, without syncing with the host
+        gumbel = -torch.empty_like(actions).exponential_().log()
+        scores = actions + gumbel
+        if action_mask is not None:
+            scores = scores.masked_fill(~action_mask.to(scores.device), float('-inf'))
+        return scores.argmax(dim=1, keepdim=True)
 
 
 class A2CAgent(Agent):
@@ -95,28 +118,42 @@ class A2CAgent(Agent):
     def __init__(self, name,
                  env_conf: EnvConf,
                  scripted_func: Callable[[Game], Optional[Action]] = None,
-                 filename=model_filename):
+                 filename=model_filename,
+                 inference_client=None,
+                 device=device,
+                 trace=trace_cpu_policy):
         super().__init__(name)
-        self.env = BotBowlEnv(env_conf)
+        self.env = model_registry.get_env(env_conf)
 
         self.scripted_func = scripted_func
-        self.action_queue = []
+        self.action_queue = ActionQueue()
 
         # MODEL
-        self.policy = torch.load(filename)
-        self.policy.eval()
+        self.filename = filename
+        self.inference_client = inference_client
+        self.device = torch.device(device)
+        self.policy = None
+        self.traced_policy = None
+        self.trace = trace and self.device.type == 'cpu'
+        if inference_client is None:
+            if self.device.type == 'cpu' and cpu_threads is not None:
+                # Process-wide, so only set for processes that do nothing but inference
+                torch.set_num_threads(cpu_threads)
+            self.policy = model_registry.get_policy(filename, self.device)
         self.end_setup = False
 
     def new_game(self, game, team):
-        pass
+        self.action_queue.clear()
 
     @staticmethod
     def _update_obs(array: np.ndarray):
         return torch.unsqueeze(torch.from_numpy(array.copy()), dim=0)
 
     def act(self, game):
-        if len(self.action_queue) > 0:
-            return self.action_queue.pop(0)
+        while len(self.action_queue) > 0:
+            action = self.action_queue.pop_allowed(game)
+            if action is not None:
+                return action
 
         if self.scripted_func is not None:
             scripted_action = self.scripted_func(game)
@@ -125,20 +162,34 @@ class A2CAgent(Agent):
 
         self.env.game = game
 
-        spatial_obs, non_spatial_obs, action_mask = map(A2CAgent._update_obs, self.env.get_state())
-        non_spatial_obs = torch.unsqueeze(non_spatial_obs, dim=0)
+        if self.inference_client is not None:
+            action_idx = self.inference_client.act(self.filename, *self.env.get_state())
+        else:
+            spatial_obs, non_spatial_obs, action_mask = map(A2CAgent._update_obs, self.env.get_state())
+            non_spatial_obs = torch.unsqueeze(non_spatial_obs, dim=0)
 
-        _, actions = self.policy.act(
-            spatial_obs.float().cuda(),
-            non_spatial_obs.float().cuda(),
-            action_mask.cuda()
-        )
+            _, actions = self.policy_act(
+                spatial_obs.float().to(self.device),
+                non_spatial_obs.float().to(self.device),
+                action_mask.to(self.device)
+            )
 
-        action_idx = actions[0].item()
+            action_idx = actions[0].item()
         action_objects = self.env._compute_action(action_idx)
 
-        self.action_queue = action_objects
-        return self.action_queue.pop(0)
+        self.action_queue.extend(action_objects)
+        return self.action_queue.popleft()
+
+    def policy_act(self, spatial_obs, non_spatial_obs, action_mask):
+        if not self.trace:
+            with torch.inference_mode():
+                return self.policy.act(spatial_obs, non_spatial_obs, action_mask)
+        if self.traced_policy is None:
+            with torch.no_grad():
+                self.traced_policy = torch.jit.freeze(torch.jit.trace(self.policy, (spatial_obs, non_spatial_obs)))
+        with torch.inference_mode():
+            values, actions = self.traced_policy(spatial_obs, non_spatial_obs)
+            return values, CNNPolicy.sample_actions(actions, action_mask)
 
     def end_game(self, game):
-        pass
\ No newline at end of file
+        pass
\ No newline at end of file
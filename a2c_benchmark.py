@@ -0,0 +1,327 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.multiprocessing import Process
+from botbowl.ai.env import BotBowlEnv, EnvConf
+from implementation.a2c.a2c_agent import A2CAgent, CNNPolicy
+from implementation.a2c.a2c_env import A2C_Reward
+from implementation.a2c import a2c_trainer
+from implementation.a2c.a2c_trainer import Memory, TransferPipeline
+from implementation.scripted_bot import CustomScriptedBot
+
+env_size = 11
+num_states = 200
+num_repeats = 20
+num_decisions = 200
+num_hidden_nodes = 512
+num_cnn_kernels = [32, 64]
+sampling_batch_sizes = [8, 64, 256, 1024]
+returns_steps = [20, 100, 500]
+returns_processes = 8
+transfer_steps = 200
+transfer_envs = 8
+transfer_trace_dir = "logs/"
+benchmark_training = False
+sample_efficiency_steps = 1000000
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def _full_board_states(num_states, env_size=env_size, seed=0):
+    rnd = np.random.RandomState(seed)
+    env = BotBowlEnv(EnvConf(size=env_size))
+    _, _, action_mask = env.reset()
+    while num_states > 0:
+        action_idx = rnd.choice(np.flatnonzero(action_mask))
+        (_, _, action_mask), _, done, _ = env.step(action_idx)
+        if done:
+            _, _, action_mask = env.reset()
+            continue
+        game = env.game
+        players_on_pitch = [player for team in (game.state.home_team, game.state.away_team)
+                            for player in team.players if player.position is not None]
+        if len(players_on_pitch) == 2 * env_size and game.active_team is not None:
+            num_states -= 1
+            yield game
+
+
+def _reference_tackle_zones(reward: A2C_Reward, game):
+    board_tackle_zones = np.zeros((game.arena.height, game.arena.width))
+    directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+    for y, row in enumerate(game.state.pitch.board):
+        for x, player in enumerate(row):
+            if player:
+                board_tackle_zones[y][x] = None
+                for dy, dx in directions:
+                    ny, nx = y + dy, x + dx
+                    if 0 <= ny < game.arena.height and 0 <= nx < game.arena.width:
+                        if game.state.pitch.board[ny][nx] is None:
+                            board_tackle_zones[ny][nx] += 1 if player.team == reward.my_team else -1
+                            if board_tackle_zones[ny][nx] == 2:
+                                board_tackle_zones[ny][nx] += reward.DOUBLE_BLOCK_BONUS
+                        else:
+                            board_tackle_zones[ny][nx] = None
+    ball = game.get_ball()
+    if ball is not None:
+        far_range = reward.TACKLE_ZONE_BALL_FAR_RANGE
+        for dy in range(-far_range, far_range + 1):
+            for dx in range(-far_range, far_range + 1):
+                ny, nx = ball.position.y + dy, ball.position.x + dx
+                if 0 <= ny < game.arena.height and 0 <= nx < game.arena.width:
+                    distance = abs(dy) + abs(dx)
+                    if distance == 0:
+                        board_tackle_zones[ny][nx] *= reward.TACKLE_ZONE_BALL_WEIGHT
+                    elif distance == 1:
+                        board_tackle_zones[ny][nx] *= reward.TACKLE_ZONE_BALL_CLOSE_RANGE_WEIGHT
+                    elif distance <= far_range:
+                        board_tackle_zones[ny][nx] *= reward.TACKLE_ZONE_BALL_FAR_RANGE_WEIGHT
+    return reward._positive_multiply(np.nansum(board_tackle_zones) * reward.TACKLE_ZONE_REWARD)
+
+
+def benchmark_tackle_zones():
+    reward = A2C_Reward()
+    reference_time = 0.0
+    vectorized_time = 0.0
+    incremental_time = 0.0
+    for game in _full_board_states(num_states):
+        reward.my_team = game.active_team
+        reward.opp_team = game.get_opp_team(reward.my_team)
+
+        start = time.perf_counter()
+        actual = reward.calculate_tackle_zones_reward(game)
+        incremental_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(num_repeats):
+            expected = _reference_tackle_zones(reward, game)
+        reference_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(num_repeats):
+            reward.board_tracker.needs_rebuild = True
+            reward.calculate_tackle_zones_reward(game)
+        vectorized_time += time.perf_counter() - start
+
+        assert expected == actual, f"Tackle zone reward mismatch: {expected} != {actual}"
+
+    calls = num_states * num_repeats
+    print(f"Tackle zones reference: {reference_time / calls * 1e6:.1f} us/step")
+    print(f"Tackle zones vectorized: {vectorized_time / calls * 1e6:.1f} us/step")
+    print(f"Tackle zones incremental: {incremental_time / num_states * 1e6:.1f} us/step")
+    print(f"Tackle zones speedup: {reference_time / vectorized_time:.1f}x vectorized, "
+          f"{reference_time / calls / (incremental_time / num_states):.1f}x incremental")
+
+
+def benchmark_reward():
+    reward = A2C_Reward()
+    reward_time = 0.0
+    full_reward_time = 0.0
+    for game in _full_board_states(num_states):
+        start = time.perf_counter()
+        reward(game)
+        reward_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        A2C_Reward()(game)
+        full_reward_time += time.perf_counter() - start
+
+    print(f"Reward from scratch: {full_reward_time / num_states * 1e6:.1f} us/step")
+    print(f"Reward incremental: {reward_time / num_states * 1e6:.1f} us/step")
+
+
+def benchmark_cpu_inference():
+    env = BotBowlEnv(EnvConf(size=env_size))
+    spatial_obs, non_spatial_obs, action_mask = env.reset()
+    policy = CNNPolicy(spatial_obs.shape, non_spatial_obs.shape[0], hidden_nodes=num_hidden_nodes,
+                       kernels=num_cnn_kernels, actions=len(action_mask))
+    spatial_obs = torch.from_numpy(spatial_obs.copy()).float().unsqueeze(dim=0)
+    non_spatial_obs = torch.from_numpy(non_spatial_obs.copy()).float().view(1, 1, -1)
+    action_mask = torch.from_numpy(action_mask.copy()).unsqueeze(dim=0)
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        model_path = os.path.join(model_dir, "benchmark.nn")
+        torch.save(policy, model_path)
+        agents = {
+            'eager': A2CAgent("eager", EnvConf(size=env_size), filename=model_path, device='cpu', trace=False),
+            'traced': A2CAgent("traced", EnvConf(size=env_size), filename=model_path, device='cpu', trace=True)
+        }
+
+    start = time.perf_counter()
+    for _ in range(num_decisions):
+        agents['eager'].policy.act(spatial_obs, non_spatial_obs, action_mask.clone())
+    print(f"CPU latency autograd: {(time.perf_counter() - start) / num_decisions * 1e3:.2f} ms/decision")
+    for mode, agent in agents.items():
+        agent.policy_act(spatial_obs, non_spatial_obs, action_mask)
+        start = time.perf_counter()
+        for _ in range(num_decisions):
+            agent.policy_act(spatial_obs, non_spatial_obs, action_mask)
+        print(f"CPU latency {mode}: {(time.perf_counter() - start) / num_decisions * 1e3:.2f} ms/decision")
+
+
+def _reference_sample_actions(actions, action_mask):
+    actions[~action_mask] = float('-inf')
+    action_probs = torch.softmax(actions, dim=1)
+    sampled = action_probs.multinomial(1)
+    for i, action in enumerate(sampled):
+        while not action_mask[i][action]:
+            action = action_probs[i].multinomial(1)
+        sampled[i] = action
+    return sampled
+
+
+def _time_sampling(sample, logits, action_mask):
+    sample(logits.clone(), action_mask)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        sample(logits.clone(), action_mask)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_repeats
+
+
+def benchmark_masked_sampling():
+    env = BotBowlEnv(EnvConf(size=env_size))
+    _, _, action_mask = env.reset()
+    for batch_size in sampling_batch_sizes:
+        logits = torch.randn(batch_size, len(action_mask), device=device)
+        batch_mask = torch.rand(batch_size, len(action_mask), device=device) < 0.01
+        batch_mask[:, 0] = True
+        reference_time = _time_sampling(_reference_sample_actions, logits, batch_mask)
+        batched_time = _time_sampling(CNNPolicy.sample_actions, logits, batch_mask)
+        print(f"Masked sampling batch {batch_size}: {batch_size / reference_time:.0f} samples/s loop, "
+              f"{batch_size / batched_time:.0f} samples/s batched")
+
+
+def benchmark_blitz_planner():
+    bot = CustomScriptedBot("benchmark")
+    plan_time = 0.0
+    for game in _full_board_states(num_states):
+        bot.my_team = game.active_team
+        bot.opp_team = game.get_opp_team(bot.my_team)
+        bot.open_players = bot.get_open_players(game)
+        bot.plan_paths = {}
+        start = time.perf_counter()
+        bot.plan_blitz(game)
+        plan_time += time.perf_counter() - start
+
+    avoided = bot.blitz_paths - bot.blitz_prob_evaluations
+    print(f"Blitz planner: {bot.blitz_prob_evaluations} of {bot.blitz_paths} blitz prob evaluations, "
+          f"{avoided / max(bot.blitz_paths, 1):.0%} avoided, {plan_time / num_states * 1e3:.2f} ms/plan")
+
+
+def _time_returns(memory, next_value, gae_lambda, method):
+    memory.compute_returns(next_value, 0.99, gae_lambda, method)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        memory.compute_returns(next_value, 0.99, gae_lambda, method)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_repeats, memory.returns.clone()
+
+
+def benchmark_returns():
+    for steps in returns_steps:
+        memory = Memory(steps, returns_processes, (1, 1, 1), (1, 1), 1)
+        memory.to(device)
+        memory.rewards.normal_()
+        memory.values.normal_()
+        memory.masks[:-1] = (torch.rand_like(memory.masks[:-1]) > 0.01).float()
+        next_value = torch.randn(returns_processes, 1, device=device)
+        for name, gae_lambda in (('returns', None), ('GAE', 0.95)):
+            loop_time, expected = _time_returns(memory, next_value, gae_lambda, 'loop')
+            scan_time, actual = _time_returns(memory, next_value, gae_lambda, 'scan')
+            assert torch.allclose(expected, actual, atol=1e-4), f"{name} mismatch for {steps} steps"
+            print(f"Discounted {name} {steps} steps: {loop_time * 1e3:.2f} ms loop, {scan_time * 1e3:.2f} ms scan")
+
+
+def _time_transfers(policy, transfers, results, trace_filename):
+    activities = [torch.profiler.ProfilerActivity.CPU, torch.profiler.ProfilerActivity.CUDA]
+    with torch.profiler.profile(activities=activities) as profiler:
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(transfer_steps):
+            spatial_obs, non_spatial_obs, action_masks, _, _ = transfers.stage(*results)
+            with torch.no_grad():
+                policy.act_with_log_probs(spatial_obs.to(device), non_spatial_obs.to(device),
+                                          action_masks.to(device))
+        torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+    profiler.export_chrome_trace(trace_filename)
+    return elapsed / transfer_steps
+
+
+def benchmark_transfer_pipeline():
+    """
+    Stages fixed env results and acts on them, with synchronous copies and with the pinned pipeline, and writes
+    a profiler trace of each to transfer_trace_dir.
+    """
+    if device.type != 'cuda':
+        print("Transfer pipeline: skipped, needs CUDA")
+        return
+    env = BotBowlEnv(EnvConf(size=env_size))
+    spatial_obs, non_spatial_obs, action_mask = env.reset()
+    policy = CNNPolicy(spatial_obs.shape, non_spatial_obs.shape[0], hidden_nodes=num_hidden_nodes,
+                       kernels=num_cnn_kernels, actions=len(action_mask)).to(device)
+    results = (np.repeat(spatial_obs[None], transfer_envs, axis=0),
+               np.repeat(non_spatial_obs[None], transfer_envs, axis=0),
+               np.repeat(action_mask[None], transfer_envs, axis=0),
+               np.zeros(transfer_envs), np.zeros(transfer_envs, dtype=bool))
+    os.makedirs(transfer_trace_dir, exist_ok=True)
+    pinned_transfers = a2c_trainer.pinned_transfers
+    for mode, pinned in (('synchronous', False), ('pinned', True)):
+        a2c_trainer.pinned_transfers = pinned
+        transfers = TransferPipeline(transfer_envs, spatial_obs.shape, (1, non_spatial_obs.shape[0]),
+                                     len(action_mask), device=device)
+        trace_filename = os.path.join(transfer_trace_dir, f"transfer_{mode}_trace.json")
+        step_time = _time_transfers(policy, transfers, results, trace_filename)
+        print(f"Transfer {mode}: {step_time * 1e3:.2f} ms/step, trace in {trace_filename}")
+    a2c_trainer.pinned_transfers = pinned_transfers
+
+
+def _train_sample_efficiency(mode, exp_id):
+    # Includes the settings the trainer derives from num_steps at import time
+    a2c_trainer.num_steps = sample_efficiency_steps
+    a2c_trainer.selfplay_save_steps = int(sample_efficiency_steps / 10)
+    a2c_trainer.selfplay_swap_steps = a2c_trainer.selfplay_save_steps
+    a2c_trainer.training_mode = mode
+    a2c_trainer.exp_id = exp_id
+    a2c_trainer.main()
+
+
+def benchmark_sample_efficiency():
+    logs = {}
+    for mode in ('a2c', 'ppo'):
+        exp_id = f"sample_efficiency_{mode}_{int(time.time())}"
+        # Each run gets a fresh process, so no trainer module state carries over from the previous one
+        process = Process(target=_train_sample_efficiency, args=(mode, exp_id))
+        process.start()
+        process.join()
+        assert process.exitcode == 0, f"{mode} training failed"
+        log = np.loadtxt(os.path.join(a2c_trainer.log_dir, f"{exp_id}.dat"), delimiter=',', ndmin=2)
+        logs[mode] = log[:, 2], log[:, 3]
+    for fraction in (0.25, 0.5, 0.75, 1.0):
+        steps = fraction * sample_efficiency_steps
+        win_rates = [np.interp(steps, *logs[mode]) for mode in ('a2c', 'ppo')]
+        print(f"Win rate after {steps:.0f} steps: {win_rates[0]:.2f} A2C, {win_rates[1]:.2f} PPO")
+
+
+def main():
+    benchmark_tackle_zones()
+    benchmark_reward()
+    benchmark_cpu_inference()
+    benchmark_masked_sampling()
+    benchmark_blitz_planner()
+    benchmark_returns()
+    benchmark_transfer_pipeline()
+    if benchmark_training:
+        benchmark_sample_efficiency()
+
+
+if __name__ == "__main__":
+    main()
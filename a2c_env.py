@@ -2,7 +2,89 @@ import numpy as np
 from botbowl import OutcomeType, Game
 import botbowl.core.procedure as procedure
 from implementation.scripted_bot import CustomScriptedBot
-import botbowl.core.pathfinding as pathfinding_module
+from implementation.pathfinding_cache import pathfinding_cache
+
+
+class BoardStateTracker:
+    FULL_REBUILD_SQUARES = 8
+
+    def __init__(self):
+        self.game = None
+        self.my_team = None
+        self.last_report_idx = 0
+        self.player_states = {}
+        self.ball_position = None
+        self.occupied = None
+        self.team_sign = None
+        self.dirty_squares = set()
+        self.needs_rebuild = True
+
+    def update(self, game: Game, my_team):
+        """
+        Applies the player moves and new reports since the last call and returns whether the board changed.
+        Squares whose occupancy changed are collected in dirty_squares until consumed by the caller.
+        """
+        board_changed = False
+        if game is not self.game or my_team != self.my_team or len(game.state.reports) < self.last_report_idx:
+            self._reset(game, my_team)
+            board_changed = True
+        if len(game.state.reports) > self.last_report_idx:
+            self.last_report_idx = len(game.state.reports)
+            board_changed = True
+
+        moves = []
+        for side, team in enumerate((game.state.home_team, game.state.away_team)):
+            for player in team.players:
+                position = (player.position.x, player.position.y) if player.position is not None else None
+                state = (position, player.state.up, player.state.used, player.state.moves)
+                last_state = self.player_states.get((side, player.player_id))
+                if state == last_state:
+                    continue
+                board_changed = True
+                self.player_states[(side, player.player_id)] = state
+                last_position = last_state[0] if last_state is not None else None
+                if position != last_position:
+                    moves.append((last_position, position, 1 if team == my_team else -1))
+        for last_position, _, _ in moves:
+            if last_position is not None:
+                self.occupied[last_position[1], last_position[0]] = False
+                self.team_sign[last_position[1], last_position[0]] = 0
+                self.dirty_squares.add(last_position)
+        for _, position, sign in moves:
+            if position is not None:
+                self.occupied[position[1], position[0]] = True
+                self.team_sign[position[1], position[0]] = sign
+                self.dirty_squares.add(position)
+        if len(self.dirty_squares) > self.FULL_REBUILD_SQUARES:
+            self.needs_rebuild = True
+
+        ball_position = game.get_ball_position()
+        ball_position = (ball_position.x, ball_position.y) if ball_position is not None else None
+        if ball_position != self.ball_position:
+            self.ball_position = ball_position
+            board_changed = True
+        return board_changed
+
+    def _reset(self, game, my_team):
+        self.game = game
+        self.my_team = my_team
+        self.last_report_idx = 0
+        self.player_states = {}
+        self.ball_position = None
+        self.occupied = np.zeros((game.arena.height, game.arena.width), dtype=bool)
+        self.team_sign = np.zeros((game.arena.height, game.arena.width))
+        self.dirty_squares = set()
+        self.needs_rebuild = True
+
+    def get_affected_squares(self):
+        height, width = self.occupied.shape
+        affected = set()
+        for x, y in self.dirty_squares:
+            for dy, dx in ((0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)):
+                ny, nx = y + dy, x + dx
+                if 0 <= ny < height and 0 <= nx < width:
+                    affected.add((ny, nx))
+        return affected
 
 
 class A2C_Reward:
@@ -49,18 +131,24 @@ class A2C_Reward:
         self.control_ball_reward = 0
         self.my_team = None
         self.opp_team = None
+        self.ball_weight_kernel = self._get_ball_weight_kernel()
+        self.board_tracker = BoardStateTracker()
+        self.board_tackle_zones = None
+        self.path_rewards = None
 
     def __call__(self, game: Game):
         self.my_team = game.active_team
         self.opp_team = game.get_opp_team(self.my_team)
         if len(game.state.reports) < self.last_report_idx:
             self.last_report_idx = 0
+        board_changed = self.board_tracker.update(game, self.my_team)
         report_reward = self.calculate_report_rewards(game)
         ball_progression_reward = self.calculate_ball_progression_reward(game)
         tackle_zones_reward = self.calculate_tackle_zones_reward(game)
         control_ball_reward = self.calculate_control_ball_reward(game)
-        path_to_touchdown_reward = self.calculate_path_to_touchdown_reward(game)
-        ball_pickup_reward = self.calculate_ball_pickup_reward(game)
+        if board_changed or self.path_rewards is None:
+            self.path_rewards = (self.calculate_path_to_touchdown_reward(game), self.calculate_ball_pickup_reward(game))
+        path_to_touchdown_reward, ball_pickup_reward = self.path_rewards
 
         return report_reward + ball_progression_reward  + tackle_zones_reward + control_ball_reward + \
             path_to_touchdown_reward + ball_pickup_reward
@@ -108,46 +196,77 @@ class A2C_Reward:
         return self.last_ball_team == self.my_team and ball_carrier.team == self.my_team
 
     def calculate_tackle_zones_reward(self, game):
-        board_tackle_zones = self._get_initial_tackle_zones(game)
+        # Cheap if __call__ already applied this board
+        self.board_tracker.update(game, self.my_team)
+        board_tackle_zones = self._update_tackle_zones().copy()
         ball = game.get_ball()
         if ball is not None:
             self._adjust_for_ball_location(board_tackle_zones, ball.position, game.arena.height, game.arena.width)
         reward = np.nansum(np.where(board_tackle_zones is None, np.nan, board_tackle_zones)) * self.TACKLE_ZONE_REWARD
         return self._positive_multiply(reward)
 
-    def _get_initial_tackle_zones(self, game):
-        board_tackle_zones = np.zeros((game.arena.height, game.arena.width))
-        directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-        for y, row in enumerate(game.state.pitch.board):
-            for x, player in enumerate(row):
-                if player:
-                    board_tackle_zones[y][x] = None
-                    for dy, dx in directions:
-                        ny, nx = y + dy, x + dx
-                        if 0 <= ny < game.arena.height and 0 <= nx < game.arena.width:
-                            if game.state.pitch.board[ny][nx] is None:
-                                board_tackle_zones[ny][nx] += 1 if player.team == self.my_team else -1
-                                if board_tackle_zones[ny][nx] == 2:
-                                    board_tackle_zones[ny][nx] += self.DOUBLE_BLOCK_BONUS
-                            else:
-                                board_tackle_zones[ny][nx] = None
+    def _update_tackle_zones(self):
+        tracker = self.board_tracker
+        if tracker.needs_rebuild or self.board_tackle_zones is None:
+            self.board_tackle_zones = self._get_initial_tackle_zones(tracker.occupied, tracker.team_sign)
+        else:
+            for y, x in tracker.get_affected_squares():
+                self.board_tackle_zones[y, x] = self._get_tackle_zone_at(tracker.occupied, tracker.team_sign, y, x)
+        tracker.needs_rebuild = False
+        tracker.dirty_squares.clear()
+        return self.board_tackle_zones
+
+    def _get_tackle_zone_at(self, occupied, team_sign, y, x):
+        if occupied[y, x]:
+            return np.nan
+        height, width = occupied.shape
+        tackle_zone = 0
+        double_block = False
+        for dy, dx in ((-1, 0), (0, -1), (0, 1), (1, 0)):
+            ny, nx = y + dy, x + dx
+            if 0 <= ny < height and 0 <= nx < width and occupied[ny, nx]:
+                tackle_zone += team_sign[ny, nx]
+                double_block |= tackle_zone == 2
+        return tackle_zone + self.DOUBLE_BLOCK_BONUS if double_block else tackle_zone
+
+    def _get_initial_tackle_zones(self, occupied, team_sign):
+        # Contributions arrive in board scan order (up, left, right, down), and the double block bonus is
+        # granted the first time the running sum of a square reaches 2.
+        from_up = np.zeros_like(team_sign)
+        from_up[1:, :] = team_sign[:-1, :]
+        from_left = np.zeros_like(team_sign)
+        from_left[:, 1:] = team_sign[:, :-1]
+        from_right = np.zeros_like(team_sign)
+        from_right[:, :-1] = team_sign[:, 1:]
+        from_down = np.zeros_like(team_sign)
+        from_down[:-1, :] = team_sign[1:, :]
+        board_tackle_zones = np.zeros_like(team_sign)
+        double_block = np.zeros(occupied.shape, dtype=bool)
+        for contribution in (from_up, from_left, from_right, from_down):
+            board_tackle_zones += contribution
+            double_block |= board_tackle_zones == 2
+        board_tackle_zones[double_block] += self.DOUBLE_BLOCK_BONUS
+        board_tackle_zones[occupied] = np.nan
         return board_tackle_zones
 
+    def _get_ball_weight_kernel(self):
+        far_range = self.TACKLE_ZONE_BALL_FAR_RANGE
+        dy, dx = np.mgrid[-far_range:far_range + 1, -far_range:far_range + 1]
+        distance = np.abs(dy) + np.abs(dx)
+        kernel = np.ones(distance.shape)
+        kernel[(distance > 1) & (distance <= far_range)] = self.TACKLE_ZONE_BALL_FAR_RANGE_WEIGHT
+        kernel[distance == 1] = self.TACKLE_ZONE_BALL_CLOSE_RANGE_WEIGHT
+        kernel[distance == 0] = self.TACKLE_ZONE_BALL_WEIGHT
+        return kernel
+
     def _adjust_for_ball_location(self, board_tackle_zones, ball_position, arena_height, arena_width):
         ball_x, ball_y = ball_position.x, ball_position.y
-        if board_tackle_zones[ball_y][ball_x] is not None:
-            board_tackle_zones[ball_y][ball_x] *= self.TACKLE_ZONE_BALL_WEIGHT
-        for dy in range(-self.TACKLE_ZONE_BALL_FAR_RANGE, self.TACKLE_ZONE_BALL_FAR_RANGE + 1):
-            for dx in range(-self.TACKLE_ZONE_BALL_FAR_RANGE, self.TACKLE_ZONE_BALL_FAR_RANGE + 1):
-                ny, nx = ball_y + dy, ball_x + dx
-                if 0 <= ny < arena_height and 0 <= nx < arena_width:
-                    distance = abs(dy) + abs(dx)
-                    if distance == 1:
-                        if board_tackle_zones[ny][nx] is not None:
-                            board_tackle_zones[ny][nx] *= self.TACKLE_ZONE_BALL_CLOSE_RANGE_WEIGHT
-                    elif 1 < distance <= self.TACKLE_ZONE_BALL_FAR_RANGE:
-                        if board_tackle_zones[ny][nx] is not None:
-                            board_tackle_zones[ny][nx] *= self.TACKLE_ZONE_BALL_FAR_RANGE_WEIGHT
+        far_range = self.TACKLE_ZONE_BALL_FAR_RANGE
+        top, bottom = max(0, ball_y - far_range), min(arena_height, ball_y + far_range + 1)
+        left, right = max(0, ball_x - far_range), min(arena_width, ball_x + far_range + 1)
+        board_tackle_zones[top:bottom, left:right] *= self.ball_weight_kernel[
+            top - ball_y + far_range:bottom - ball_y + far_range,
+            left - ball_x + far_range:right - ball_x + far_range]
 
     def calculate_control_ball_reward(self, game):
         ball_carrier = game.get_ball_carrier()
@@ -165,7 +284,7 @@ class A2C_Reward:
         if ball_carrier is not None:
             target = game.get_opp_endzone_x(self.my_team) if self._has_ball(game) else game.get_opp_endzone_x(self.opp_team)
             if ball_carrier.position.x is not target:
-                paths = pathfinding_module.get_all_paths(game, ball_carrier)
+                paths = pathfinding_cache.get_all_paths(game, ball_carrier)
                 for path in paths:
                     distance = abs(target - path.steps[-1].x) if abs(target - path.steps[-1].x) > 0 else 1
                     if path.prob == 1 and game.num_tackle_zones_at(ball_carrier, path.get_last_step()) == 0:
@@ -191,7 +310,7 @@ class A2C_Reward:
 
     def _get_pickup_reward(self, game, ball_position, player, team):
         if player.position.distance(ball_position) <= player.get_ma():
-            path = pathfinding_module.get_safest_path(game, player, ball_position)
+            path = pathfinding_cache.get_safest_path(game, player, ball_position)
             if path is not None:
                 distance_to_endzone = abs(game.get_opp_endzone_x(team) - path.steps[-1].x)
                 if distance_to_endzone != 0:
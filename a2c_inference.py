@@ -0,0 +1,99 @@
+import queue
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+import torch
+from torch.multiprocessing import Process, Queue
+
+max_batch_size = 32
+max_latency = 0.002
+max_models = 4
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+class InferenceClient:
+    def __init__(self, client_id, request_queue, response_queue):
+        self.client_id = client_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+
+    def act(self, filename, spatial_obs, non_spatial_obs, action_mask):
+        self.request_queue.put((self.client_id, filename, spatial_obs, non_spatial_obs, action_mask))
+        return self.response_queue.get()
+
+
+def _load_policy(policies, filename):
+    if filename in policies:
+        policies.move_to_end(filename)
+        return policies[filename]
+    policy = torch.load(filename, map_location=device)
+    policy.eval()
+    policies[filename] = policy
+    if len(policies) > max_models:
+        policies.popitem(last=False)
+    return policy
+
+
+def _serve_batch(policies, batch, response_queues):
+    requests_by_model = defaultdict(list)
+    for request in batch:
+        requests_by_model[request[1]].append(request)
+    for filename, requests in requests_by_model.items():
+        policy = _load_policy(policies, filename)
+        client_ids, _, spatial_obs, non_spatial_obs, action_mask = zip(*requests)
+        spatial_obs = torch.from_numpy(np.stack(spatial_obs)).float()
+        non_spatial_obs = torch.from_numpy(np.stack(non_spatial_obs)).float().unsqueeze(dim=1)
+        action_mask = torch.from_numpy(np.stack(action_mask))
+        with torch.inference_mode():
+            _, actions = policy.act(spatial_obs.to(device), non_spatial_obs.to(device), action_mask.to(device))
+        for client_id, action in zip(client_ids, actions.cpu().numpy()):
+            response_queues[client_id].put(int(action[0]))
+
+
+def inference_worker(request_queue, response_queues):
+    policies = OrderedDict()
+    running = True
+    while running:
+        request = request_queue.get()
+        if request is None:
+            break
+        batch = [request]
+        deadline = time.perf_counter() + max_latency
+        while len(batch) < max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = request_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                running = False
+                break
+            batch.append(request)
+        _serve_batch(policies, batch, response_queues)
+
+
+class InferenceServer:
+    """
+    Holds one copy of each opponent policy in a separate process and batches the decisions requested by the
+    clients of all env workers, up to max_batch_size requests or max_latency seconds after the first one.
+    """
+    def __init__(self, num_clients):
+        self.closed = False
+        self.request_queue = Queue()
+        self.response_queues = [Queue() for _ in range(num_clients)]
+        self.process = Process(target=inference_worker, args=(self.request_queue, self.response_queues))
+        self.process.daemon = True
+        self.process.start()
+
+    def get_client(self, client_id):
+        return InferenceClient(client_id, self.request_queue, self.response_queues[client_id])
+
+    def close(self):
+        if self.closed:
+            return
+        self.request_queue.put(None)
+        self.process.join()
+        self.closed = True
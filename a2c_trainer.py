@@ -1,25 +1,32 @@
 import sys
 sys.path.append('.')
 
+import copy
+import queue
 import random
+import threading
+import time
+from collections import defaultdict
 from functools import partial
+from multiprocessing.connection import wait
 from torch.multiprocessing import Pipe, Process, set_start_method
 try:
      set_start_method('spawn')
 except RuntimeError:
     pass
 
-from typing import Tuple, Iterable
+from typing import Tuple, Iterable, List
 
 import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.autograd import Variable
 import botbowl
 from botbowl.ai.env import BotBowlEnv, RewardWrapper, EnvConf, BotBowlWrapper, PPCGWrapper
 from implementation.a2c.a2c_agent import A2CAgent, CNNPolicy
 from implementation.a2c.a2c_env import A2C_Reward, a2c_scripted_actions
+from implementation.a2c.a2c_inference import InferenceServer
+from implementation.model_registry import model_registry
 from botbowl.ai.layers import *
 
 env_size = 11
@@ -56,8 +63,27 @@ selfplay = True
 selfplay_window = 1
 selfplay_save_steps = int(num_steps / 10)
 selfplay_swap_steps = selfplay_save_steps
+use_inference_server = False
+shared_memory_obs = False
+async_envs = False
+async_min_batch_size = num_processes // 2
+async_timeout = 0.005
+envs_per_worker = 1
+returns_method = 'scan'
+compact_memory = False
+pinned_transfers = True
+use_gae = False
+gae_lambda = 0.95
+training_mode = 'a2c'
+impala_queue_size = 2
+vtrace_rho_clip = 1.0
+vtrace_c_clip = 1.0
+ppo_epochs = 4
+ppo_minibatches = 4
+ppo_clip = 0.2
 num_hidden_nodes = 512
 num_cnn_kernels = [32, 64]
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
 def ensure_dir(file_path):
@@ -78,97 +104,593 @@ ensure_dir(model_dir)
 ensure_dir(plot_dir)
 
 
+def linear_recurrence_scan(coefficients, values, last):
+    """
+    Solves x[t] = values[t] + coefficients[t] * x[t + 1] backwards in time with x[T] = last. Neighbouring steps
+    are composed pairwise, so this takes log2(T) vectorized passes instead of T sequential ones.
+    """
+    offset = 1
+    while offset < values.shape[0]:
+        values = torch.cat((values[:-offset] + coefficients[:-offset] * values[offset:], values[-offset:]))
+        coefficients = torch.cat((coefficients[:-offset] * coefficients[offset:], coefficients[-offset:]))
+        offset *= 2
+    return values + coefficients * last
+
+
+class CompactTensor:
+    """
+    Float tensor stored as uint8 for the channels that have only held 0s and 1s so far and as float16 for the
+    rest. A channel moves to float16 the first time a non-binary value is written to it. Indexing the leading
+    dims returns float32.
+    """
+    def __init__(self, *shape, channel_dim=-3):
+        self.shape = shape
+        self.channel_dim = channel_dim
+        self.binary_channels = torch.arange(shape[channel_dim])
+        self.dense_channels = torch.arange(0)
+        self.binary = torch.zeros(*self._shape(len(self.binary_channels)), dtype=torch.uint8)
+        self.dense = torch.zeros(*self._shape(0), dtype=torch.float16)
+
+    def _shape(self, num_channels):
+        shape = list(self.shape)
+        shape[self.channel_dim] = num_channels
+        return shape
+
+    @property
+    def device(self):
+        return self.binary.device
+
+    def to(self, device):
+        self.binary = self.binary.to(device)
+        self.dense = self.dense.to(device)
+        self.binary_channels = self.binary_channels.to(device)
+        self.dense_channels = self.dense_channels.to(device)
+        return self
+
+    def nbytes(self):
+        return self.binary.nelement() * self.binary.element_size() + self.dense.nelement() * self.dense.element_size()
+
+    def __getitem__(self, index):
+        binary = self.binary[index]
+        shape = list(binary.shape)
+        shape[self.channel_dim] = self.shape[self.channel_dim]
+        values = torch.empty(shape, device=self.device)
+        values.index_copy_(values.dim() + self.channel_dim, self.binary_channels, binary.float())
+        values.index_copy_(values.dim() + self.channel_dim, self.dense_channels, self.dense[index].float())
+        return values
+
+    def __setitem__(self, index, values):
+        values = values.to(self.device)
+        channel_dim = values.dim() + self.channel_dim
+        binary = values.index_select(channel_dim, self.binary_channels)
+        if len(self.binary_channels) > 0:
+            non_binary = (binary != 0) & (binary != 1)
+            non_binary = non_binary.transpose(0, channel_dim).reshape(len(self.binary_channels), -1).any(dim=1)
+            if non_binary.any():
+                self._densify(non_binary)
+                binary = values.index_select(channel_dim, self.binary_channels)
+        self.binary[index] = binary.to(torch.uint8)
+        self.dense[index] = values.index_select(channel_dim, self.dense_channels).half()
+
+    def _densify(self, non_binary):
+        channel_dim = self.binary.dim() + self.channel_dim
+        dense_channels, order = torch.cat((self.dense_channels, self.binary_channels[non_binary])).sort()
+        moved = self.binary.index_select(channel_dim, non_binary.nonzero().flatten())
+        dense = torch.cat((self.dense, moved.half()), dim=channel_dim)
+        self.dense = dense.index_select(channel_dim, order)
+        self.dense_channels = dense_channels
+        self.binary = self.binary.index_select(channel_dim, (~non_binary).nonzero().flatten())
+        self.binary_channels = self.binary_channels[~non_binary]
+
+
+class PackedBoolTensor:
+    """
+    Bool tensor with its last dim packed into bits, 8 per byte. Indexing the leading dims returns bools.
+    """
+    def __init__(self, *shape):
+        self.shape = shape
+        self.size = shape[-1]
+        self.bits = 1 << torch.arange(8, dtype=torch.uint8)
+        self.packed = torch.zeros(*shape[:-1], (self.size + 7) // 8, dtype=torch.uint8)
+
+    @property
+    def device(self):
+        return self.packed.device
+
+    def to(self, device):
+        self.packed = self.packed.to(device)
+        self.bits = self.bits.to(device)
+        return self
+
+    def nbytes(self):
+        return self.packed.nelement()
+
+    def __getitem__(self, index):
+        packed = self.packed[index]
+        values = (packed.unsqueeze(-1) & self.bits) != 0
+        return values.view(*packed.shape[:-1], -1)[..., :self.size]
+
+    def __setitem__(self, index, values):
+        values = values.to(self.device)
+        padding = self.packed.shape[-1] * 8 - self.size
+        values = nn.functional.pad(values.to(torch.uint8), (0, padding))
+        values = values.view(*values.shape[:-1], -1, 8) * self.bits
+        self.packed[index] = values.sum(dim=-1).to(torch.uint8)
+
+
+def vtrace(rewards, masks, values, next_value, log_rhos, gamma, rho_clip=vtrace_rho_clip, c_clip=vtrace_c_clip):
+    """
+    V-trace value targets and policy gradient advantages (Espeholt et al., 2018) for a rollout sampled by a
+    behaviour policy, where log_rhos are the log importance weights of the learner policy.
+    """
+    rhos = log_rhos.exp()
+    clipped_rhos = rhos.clamp(max=rho_clip)
+    cs = rhos.clamp(max=c_clip)
+    next_values = torch.cat((values[1:], next_value.unsqueeze(0)))
+    deltas = clipped_rhos * (rewards + gamma * masks * next_values - values)
+    vs = linear_recurrence_scan(gamma * masks * cs, deltas, 0) + values
+    next_vs = torch.cat((vs[1:], next_value.unsqueeze(0)))
+    advantages = clipped_rhos * (rewards + gamma * masks * next_vs - values)
+    return vs, advantages
+
+
 class Memory(object):
-    def __init__(self, steps_per_update, num_processes, spatial_obs_shape, non_spatial_obs_shape, action_space):
-        self.spatial_obs = torch.zeros(steps_per_update + 1, num_processes, *spatial_obs_shape)
-        self.non_spatial_obs = torch.zeros(steps_per_update + 1, num_processes, *non_spatial_obs_shape)
+    def __init__(self, steps_per_update, num_processes, spatial_obs_shape, non_spatial_obs_shape, action_space,
+                 compact=False):
+        self.compact = compact
+        if compact:
+            self.spatial_obs = CompactTensor(steps_per_update + 1, num_processes, *spatial_obs_shape, channel_dim=-3)
+            self.non_spatial_obs = CompactTensor(steps_per_update + 1, num_processes, *non_spatial_obs_shape,
+                                                 channel_dim=-1)
+        else:
+            self.spatial_obs = torch.zeros(steps_per_update + 1, num_processes, *spatial_obs_shape)
+            self.non_spatial_obs = torch.zeros(steps_per_update + 1, num_processes, *non_spatial_obs_shape)
         self.rewards = torch.zeros(steps_per_update, num_processes, 1)
         self.returns = torch.zeros(steps_per_update + 1, num_processes, 1)
+        self.values = torch.zeros(steps_per_update + 1, num_processes, 1)
+        self.action_log_probs = torch.zeros(steps_per_update, num_processes, 1)
+        self.policy_version = 0
         action_shape = 1
         self.actions = torch.zeros(steps_per_update, num_processes, action_shape)
         self.actions = self.actions.long()
         self.masks = torch.ones(steps_per_update + 1, num_processes, 1)
-        self.action_masks = torch.zeros(steps_per_update + 1, num_processes, action_space, dtype=torch.bool)
-
-    def cuda(self):
-        self.spatial_obs = self.spatial_obs.cuda()
-        self.non_spatial_obs = self.non_spatial_obs.cuda()
-        self.rewards = self.rewards.cuda()
-        self.returns = self.returns.cuda()
-        self.actions = self.actions.cuda()
-        self.masks = self.masks.cuda()
-        self.action_masks = self.action_masks.cuda()
-
-    def insert(self, step, spatial_obs, non_spatial_obs, action, reward, mask, action_masks):
-        self.spatial_obs[step + 1].copy_(torch.from_numpy(spatial_obs).float())
-        self.non_spatial_obs[step + 1].copy_(torch.from_numpy(np.expand_dims(non_spatial_obs, axis=1)).float())
-        self.actions[step].copy_(action)
-        self.rewards[step].copy_(torch.from_numpy(np.expand_dims(reward, 1)).float())
-        self.masks[step].copy_(mask)
-        self.action_masks[step + 1].copy_(torch.from_numpy(action_masks))
-
-    def compute_returns(self, next_value, gamma):
+        if compact:
+            self.action_masks = PackedBoolTensor(steps_per_update + 1, num_processes, action_space)
+        else:
+            self.action_masks = torch.zeros(steps_per_update + 1, num_processes, action_space, dtype=torch.bool)
+
+    def to(self, device):
+        self.spatial_obs = self.spatial_obs.to(device)
+        self.non_spatial_obs = self.non_spatial_obs.to(device)
+        self.rewards = self.rewards.to(device)
+        self.returns = self.returns.to(device)
+        self.values = self.values.to(device)
+        self.action_log_probs = self.action_log_probs.to(device)
+        self.actions = self.actions.to(device)
+        self.masks = self.masks.to(device)
+        self.action_masks = self.action_masks.to(device)
+
+    def insert(self, step, spatial_obs, non_spatial_obs, action, reward, mask, action_masks, value=None,
+               env_ids=None, action_log_prob=None):
+        """
+        Stores the step results of all envs, or of the envs in env_ids, in which case step holds the rollout step
+        of each of them. Observations, rewards and masks are tensors as staged by TransferPipeline.
+        """
+        device = self.rewards.device
+        index = step if env_ids is None else (step, env_ids)
+        next_index = step + 1 if env_ids is None else (step + 1, env_ids)
+        self.spatial_obs[next_index] = spatial_obs.to(device)
+        self.non_spatial_obs[next_index] = non_spatial_obs.to(device)
+        self.actions[index] = action.to(device)
+        self.rewards[index] = reward.to(device)
+        self.masks[index] = mask.to(device)
+        self.action_masks[next_index] = action_masks.to(device)
+        if value is not None:
+            self.values[index] = value.to(device)
+        if action_log_prob is not None:
+            self.action_log_probs[index] = action_log_prob.to(device)
+
+    def nbytes(self):
+        """
+        Returns the bytes used by the rollout storage and the bytes it would use without compact storage.
+        """
+        tensors = [self.rewards, self.returns, self.values, self.actions, self.masks]
+        used = sum(t.nelement() * t.element_size() for t in tensors)
+        full = used + 4 * (int(np.prod(self.spatial_obs.shape)) + int(np.prod(self.non_spatial_obs.shape)))
+        full += int(np.prod(self.action_masks.shape))
+        for t in (self.spatial_obs, self.non_spatial_obs, self.action_masks):
+            used += t.nbytes() if self.compact else t.nelement() * t.element_size()
+        return used, full
+
+    def roll_over(self):
+        self.start_from(self)
+
+    def start_from(self, memory):
+        self.spatial_obs[0] = memory.spatial_obs[-1]
+        self.non_spatial_obs[0] = memory.non_spatial_obs[-1]
+        self.action_masks[0] = memory.action_masks[-1]
+
+    def compute_returns(self, next_value, gamma, gae_lambda=None, method='loop'):
+        """
+        Discounted returns, or with gae_lambda the GAE advantages plus the values stored by insert(). The 'loop'
+        and 'scan' methods give the same results up to float rounding.
+        """
         self.returns[-1] = next_value
-        for step in reversed(range(self.rewards.shape[0])):
-            self.returns[step] = self.returns[step + 1] * gamma * self.masks[step] + self.rewards[step]
+        self.values[-1] = next_value
+        if method == 'scan':
+            if gae_lambda is None:
+                self.returns[:-1] = linear_recurrence_scan(gamma * self.masks[:-1], self.rewards, next_value)
+            else:
+                deltas = self.rewards + gamma * self.masks[:-1] * self.values[1:] - self.values[:-1]
+                advantages = linear_recurrence_scan(gamma * gae_lambda * self.masks[:-1], deltas, 0)
+                self.returns[:-1] = advantages + self.values[:-1]
+        elif gae_lambda is None:
+            for step in reversed(range(self.rewards.shape[0])):
+                self.returns[step] = self.returns[step + 1] * gamma * self.masks[step] + self.rewards[step]
+        else:
+            advantage = 0
+            for step in reversed(range(self.rewards.shape[0])):
+                delta = self.rewards[step] + gamma * self.values[step + 1] * self.masks[step] - self.values[step]
+                advantage = delta + gamma * gae_lambda * self.masks[step] * advantage
+                self.returns[step] = advantage + self.values[step]
+
+
+class TransferPipeline:
+    """
+    Moves step results to the device through pinned staging buffers. The copies are issued on a dedicated
+    stream without blocking the host, and the device only waits for them when it uses the results. The buffers
+    alternate between steps, so staging one step doesn't wait for the copy of the previous one. Without CUDA
+    the results are only converted to tensors.
+
+    This is non-blocking staging, not overlap with the envs of the synchronous loop: the next actions need the
+    observations just copied, so that copy is always on the critical path. Copies only run while envs step in
+    the async_envs and impala modes, where other envs are still stepping.
+    """
+    def __init__(self, num_envs, spatial_obs_shape, non_spatial_obs_shape, action_space, device=device,
+                 num_buffers=2):
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda' and pinned_transfers
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        shapes = [(num_envs, *spatial_obs_shape), (num_envs, *non_spatial_obs_shape), (num_envs, action_space),
+                  (num_envs, 1), (num_envs, 1)]
+        dtypes = [torch.float, torch.float, torch.bool, torch.float, torch.float]
+        self.host_buffers = []
+        self.device_buffers = []
+        if self.cuda:
+            for _ in range(num_buffers):
+                self.host_buffers.append([torch.zeros(shape, dtype=dtype).pin_memory()
+                                          for shape, dtype in zip(shapes, dtypes)])
+                self.device_buffers.append([torch.zeros(shape, dtype=dtype, device=self.device)
+                                            for shape, dtype in zip(shapes, dtypes)])
+        self.events = [None] * num_buffers
+        self.next_buffer = 0
+
+    def stage(self, spatial_obs, non_spatial_obs, action_masks, reward, done):
+        """
+        Returns spatial obs, non-spatial obs, action masks, rewards and done masks as float/bool tensors, on
+        the device if CUDA is used.
+        """
+        results = (spatial_obs, np.expand_dims(non_spatial_obs, axis=1), action_masks, np.expand_dims(reward, 1),
+                   np.expand_dims(1.0 - done, 1))
+        if not self.cuda:
+            return tuple(torch.from_numpy(np.asarray(result)).to(dtype)
+                         for result, dtype in zip(results, (torch.float, torch.float, torch.bool, torch.float,
+                                                            torch.float)))
+        i = self.next_buffer
+        self.next_buffer = (i + 1) % len(self.events)
+        num_envs = len(reward)
+        if self.events[i] is not None:
+            # The previous copy out of these pinned buffers must be done before they are refilled
+            self.events[i].synchronize()
+        for buffer, result in zip(self.host_buffers[i], results):
+            buffer[:num_envs].copy_(torch.from_numpy(np.asarray(result)))
+        current_stream = torch.cuda.current_stream(self.device)
+        # Earlier work on the current stream may still read these device buffers
+        self.stream.wait_stream(current_stream)
+        with torch.cuda.stream(self.stream):
+            for host_buffer, device_buffer in zip(self.host_buffers[i], self.device_buffers[i]):
+                device_buffer[:num_envs].copy_(host_buffer[:num_envs], non_blocking=True)
+            self.events[i] = torch.cuda.Event()
+            self.events[i].record(self.stream)
+        current_stream.wait_event(self.events[i])
+        return tuple(buffer[:num_envs] for buffer in self.device_buffers[i])
+
+
+class ImpalaActor(threading.Thread):
+    """
+    Fills rollouts from the envs with a copy of the policy that is synced after every learner update, so the
+    envs keep stepping during backprop. Filled rollouts wait in a bounded queue and the learner corrects for
+    the policy lag with V-trace. Opponent swaps go through the actor, as it owns the env pipes.
+    """
+    def __init__(self, envs, policy, memories, transfers, record_results, get_difficulty):
+        super().__init__(daemon=True)
+        self.envs = envs
+        self.policy = copy.deepcopy(policy)
+        self.policy_lock = threading.Lock()
+        self.policy_version = 0
+        self.memory = memories[0]
+        self.free_memories = queue.Queue()
+        for memory in memories[1:]:
+            self.free_memories.put(memory)
+        self.rollouts = queue.Queue(maxsize=impala_queue_size)
+        self.swaps = queue.Queue()
+        self.transfers = transfers
+        self.record_results = record_results
+        self.get_difficulty = get_difficulty
+        self.stopping = threading.Event()
+        self.actor_wait_time = 0.0
+        self.learner_wait_time = 0.0
+
+    def run(self):
+        while not self.stopping.is_set():
+            self._fill(self.memory)
+            start = time.perf_counter()
+            self.rollouts.put(self.memory)
+            memory = self.free_memories.get()
+            self.actor_wait_time += time.perf_counter() - start
+            memory.start_from(self.memory)
+            self.memory = memory
+
+    def _fill(self, memory):
+        all_env_ids = np.arange(num_processes)
+        for step in range(steps_per_update):
+            while not self.swaps.empty():
+                self.envs.swap(self.swaps.get())
+            with self.policy_lock, torch.no_grad():
+                values, actions, action_log_probs = self.policy.act_with_log_probs(
+                    memory.spatial_obs[step],
+                    memory.non_spatial_obs[step],
+                    memory.action_masks[step]
+                )
+                memory.policy_version = self.policy_version
+            action_objects = (action[0] for action in actions.cpu().numpy())
+            spatial_obs, non_spatial_obs, action_masks, shaped_reward, tds_scored, tds_opp_scored, done = \
+                self.envs.step(action_objects, difficulty=self.get_difficulty())
+            spatial_obs, non_spatial_obs, action_masks, rewards, masks = self.transfers.stage(
+                spatial_obs, non_spatial_obs, action_masks, shaped_reward, done)
+            self.record_results(all_env_ids, shaped_reward, tds_scored, tds_opp_scored, done)
+            memory.insert(step, spatial_obs, non_spatial_obs, actions, rewards, masks, action_masks, values,
+                          action_log_prob=action_log_probs)
+
+    def get_rollout(self):
+        start = time.perf_counter()
+        memory = self.rollouts.get()
+        self.learner_wait_time += time.perf_counter() - start
+        return memory
+
+    def release(self, memory):
+        self.free_memories.put(memory)
+
+    def sync(self, policy):
+        with self.policy_lock:
+            self.policy.load_state_dict(policy.state_dict())
+            self.policy_version += 1
+
+    def stop(self):
+        self.stopping.set()
+        # Unblock the actor if it waits for the learner
+        while self.is_alive():
+            try:
+                self.release(self.rollouts.get(timeout=0.1))
+            except queue.Empty:
+                pass
+
+
+def a2c_update(ac_agent, optimizer, memory):
+    with torch.no_grad():
+        next_value = ac_agent(memory.spatial_obs[-1], memory.non_spatial_obs[-1])[0]
+
+    memory.compute_returns(next_value, gamma, gae_lambda if use_gae else None, returns_method)
+    spatial = memory.spatial_obs[:-1]
+    spatial = spatial.view(-1, *spatial.shape[2:])
+    non_spatial = memory.non_spatial_obs[:-1]
+    non_spatial = non_spatial.view(-1, non_spatial.shape[-1])
+    actions = memory.actions.view(-1, 1)
+    actions_mask = memory.action_masks[:-1]
+    action_log_probs, values, dist_entropy = ac_agent.evaluate_actions(spatial, non_spatial, actions, actions_mask)
+    values = values.view(steps_per_update, num_processes, 1)
+    action_log_probs = action_log_probs.view(steps_per_update, num_processes, 1)
+    advantages = memory.returns[:-1] - values
+    value_loss = advantages.pow(2).mean()
+    action_loss = -(advantages.detach() * action_log_probs).mean()
+    optimizer.zero_grad()
+    total_loss = (value_loss * value_loss_coef + action_loss - dist_entropy * entropy_coef)
+    total_loss.backward()
+    nn.utils.clip_grad_norm_(ac_agent.parameters(), max_grad_norm)
+    optimizer.step()
+    return value_loss.detach(), action_loss.detach()
+
+
+def ppo_update(ac_agent, optimizer, memory):
+    with torch.no_grad():
+        next_value = ac_agent(memory.spatial_obs[-1], memory.non_spatial_obs[-1])[0]
+
+    memory.compute_returns(next_value, gamma, gae_lambda if use_gae else None, returns_method)
+    spatial = memory.spatial_obs[:-1]
+    spatial = spatial.view(-1, *spatial.shape[2:])
+    non_spatial = memory.non_spatial_obs[:-1]
+    non_spatial = non_spatial.view(-1, non_spatial.shape[-1])
+    actions = memory.actions.view(-1, 1)
+    actions_mask = memory.action_masks[:-1]
+    actions_mask = actions_mask.view(-1, 1, actions_mask.shape[-1])
+    old_action_log_probs = memory.action_log_probs.view(-1, 1)
+    returns = memory.returns[:-1].view(-1, 1)
+    advantages = returns - memory.values[:-1].view(-1, 1)
+    advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+
+    num_samples = returns.shape[0]
+    # Fewer samples than minibatches would make the minibatches empty
+    num_minibatches = min(ppo_minibatches, num_samples)
+    minibatch_size = num_samples // num_minibatches
+    value_losses = []
+    action_losses = []
+    for _ in range(ppo_epochs):
+        permutation = torch.randperm(num_samples, device=returns.device)
+        for start in range(0, minibatch_size * num_minibatches, minibatch_size):
+            batch = permutation[start:start + minibatch_size]
+            action_log_probs, values, dist_entropy = ac_agent.evaluate_actions(
+                spatial[batch], non_spatial[batch], actions[batch], actions_mask[batch])
+            ratio = torch.exp(action_log_probs - old_action_log_probs[batch])
+            surrogate = ratio * advantages[batch]
+            clipped_surrogate = ratio.clamp(1.0 - ppo_clip, 1.0 + ppo_clip) * advantages[batch]
+            action_loss = -torch.min(surrogate, clipped_surrogate).mean()
+            value_loss = (returns[batch] - values).pow(2).mean()
+            optimizer.zero_grad()
+            total_loss = (value_loss * value_loss_coef + action_loss - dist_entropy * entropy_coef)
+            total_loss.backward()
+            nn.utils.clip_grad_norm_(ac_agent.parameters(), max_grad_norm)
+            optimizer.step()
+            value_losses.append(value_loss.detach())
+            action_losses.append(action_loss.detach())
+    # Averaged over the whole update, so they compare with the single step losses of a2c_update()
+    return torch.stack(value_losses).mean(), torch.stack(action_losses).mean()
+
 
+def vtrace_update(ac_agent, optimizer, memory):
+    with torch.no_grad():
+        next_value = ac_agent(memory.spatial_obs[-1], memory.non_spatial_obs[-1])[0]
 
-def worker(remote, parent_remote, env: BotBowlWrapper, worker_id):
+    spatial = memory.spatial_obs[:-1]
+    spatial = spatial.view(-1, *spatial.shape[2:])
+    non_spatial = memory.non_spatial_obs[:-1]
+    non_spatial = non_spatial.view(-1, non_spatial.shape[-1])
+    actions = memory.actions.view(-1, 1)
+    actions_mask = memory.action_masks[:-1]
+    action_log_probs, values, dist_entropy = ac_agent.evaluate_actions(spatial, non_spatial, actions, actions_mask)
+    values = values.view(steps_per_update, num_processes, 1)
+    action_log_probs = action_log_probs.view(steps_per_update, num_processes, 1)
+    vs, advantages = vtrace(memory.rewards, memory.masks[:-1], values.detach(), next_value,
+                            action_log_probs.detach() - memory.action_log_probs, gamma)
+    value_loss = (vs - values).pow(2).mean()
+    action_loss = -(advantages * action_log_probs).mean()
+    optimizer.zero_grad()
+    total_loss = (value_loss * value_loss_coef + action_loss - dist_entropy * entropy_coef)
+    total_loss.backward()
+    nn.utils.clip_grad_norm_(ac_agent.parameters(), max_grad_norm)
+    optimizer.step()
+    return value_loss.detach(), action_loss.detach()
+
+
+class SharedObsBuffers:
+    def __init__(self, num_envs, spatial_obs_shape, non_spatial_obs_shape, action_space):
+        self.spatial_obs = torch.zeros(num_envs, *spatial_obs_shape).share_memory_()
+        self.non_spatial_obs = torch.zeros(num_envs, *non_spatial_obs_shape).share_memory_()
+        self.action_masks = torch.zeros(num_envs, action_space, dtype=torch.bool).share_memory_()
+        self.rewards = torch.zeros(num_envs, dtype=torch.float64).share_memory_()
+        self.tds_scored = torch.zeros(num_envs, dtype=torch.long).share_memory_()
+        self.tds_opp_scored = torch.zeros(num_envs, dtype=torch.long).share_memory_()
+        self.dones = torch.zeros(num_envs, dtype=torch.bool).share_memory_()
+
+    def write(self, i, spatial_obs, non_spatial_obs, action_mask, reward, tds_scored, tds_opp_scored, done):
+        self.spatial_obs[i].copy_(torch.from_numpy(spatial_obs))
+        self.non_spatial_obs[i].copy_(torch.from_numpy(non_spatial_obs))
+        self.action_masks[i].copy_(torch.from_numpy(action_mask))
+        self.rewards[i] = reward
+        self.tds_scored[i] = tds_scored
+        self.tds_opp_scored[i] = tds_opp_scored
+        self.dones[i] = bool(done)
+
+    def read(self) -> Tuple[np.ndarray, ...]:
+        """
+        Returns views of the shared buffers, which are overwritten by the next step or reset.
+        """
+        return (self.spatial_obs.numpy(), self.non_spatial_obs.numpy(), self.action_masks.numpy(),
+                self.rewards.numpy(), self.tds_scored.numpy(), self.tds_opp_scored.numpy(), self.dones.numpy())
+
+
+def copy_opponent(agent):
+    # Every env needs its own opponent state, but the loaded policy and observation builder can be shared
+    shared = [getattr(agent, 'policy', None), getattr(agent, 'env', None)]
+    return copy.deepcopy(agent, {id(obj): obj for obj in shared if obj is not None})
+
+
+class EnvRunner:
+    def __init__(self, env: BotBowlWrapper):
+        self.env = env
+        self.steps = 0
+        self.tds = 0
+        self.tds_opp = 0
+        self.next_opp = botbowl.make_bot('random') if sct else botbowl.make_bot('scripted')
+        self.ppcg_wrapper: Optional[PPCGWrapper] = env.get_wrapper_with_type(PPCGWrapper)
+
+    def step(self, action, dif):
+        self.steps += 1
+        if self.ppcg_wrapper is not None:
+            self.ppcg_wrapper.difficulty = dif
+        (spatial_obs, non_spatial_obs, action_mask), reward, done, info = self.env.step(action)
+        game = self.env.game
+        tds_scored = game.state.home_team.state.score - self.tds
+        tds_opp_scored = game.state.away_team.state.score - self.tds_opp
+        self.tds = game.state.home_team.state.score
+        self.tds_opp = game.state.away_team.state.score
+        if done or self.steps >= reset_steps:
+            if self.steps >= reset_steps:
+                print("Max. number of steps exceeded! Consider increasing the number.")
+            done = True
+            spatial_obs, non_spatial_obs, action_mask, _, _, _, _ = self.reset()
+        return spatial_obs, non_spatial_obs, action_mask, reward, tds_scored, tds_opp_scored, done
+
+    def reset(self):
+        self.steps = 0
+        self.tds = 0
+        self.tds_opp = 0
+        self.env.root_env.away_agent = self.next_opp
+        spatial_obs, non_spatial_obs, action_mask = self.env.reset()
+        return spatial_obs, non_spatial_obs, action_mask, 0.0, 0, 0, False
+
+    def swap(self, data, inference_client=None):
+        if sct and num_steps * scripted_rate > self.steps:
+            self.next_opp = botbowl.make_bot('scripted')
+        elif inference_client is not None:
+            name, filename = data
+            self.next_opp = make_agent_from_model(name=name, filename=filename, inference_client=inference_client)
+        else:
+            self.next_opp = copy_opponent(data)
+
+
+def worker(remote, parent_remote, envs: List[BotBowlWrapper], env_ids: List[int], inference_client=None,
+           buffers: Optional[SharedObsBuffers] = None):
     parent_remote.close()
-    steps = 0
-    tds = 0
-    tds_opp = 0
-    next_opp = botbowl.make_bot('random') if sct else botbowl.make_bot('scripted')
-    ppcg_wrapper: Optional[PPCGWrapper] = env.get_wrapper_with_type(PPCGWrapper)
+    runners = [EnvRunner(env) for env in envs]
     while True:
         command, data = remote.recv()
         if command == 'step':
-            steps += 1
-            action, dif = data[0], data[1]
-            if ppcg_wrapper is not None:
-                ppcg_wrapper.difficulty = dif
-            (spatial_obs, non_spatial_obs, action_mask), reward, done, info = env.step(action)
-            game = env.game
-            tds_scored = game.state.home_team.state.score - tds
-            tds_opp_scored = game.state.away_team.state.score - tds_opp
-            tds = game.state.home_team.state.score
-            tds_opp = game.state.away_team.state.score
-            if done or steps >= reset_steps:
-                if steps >= reset_steps:
-                    print("Max. number of steps exceeded! Consider increasing the number.")
-                done = True
-                env.root_env.away_agent = next_opp
-                spatial_obs, non_spatial_obs, action_mask = env.reset()
-                steps = 0
-                tds = 0
-                tds_opp = 0
-            spatial_obs = torch.from_numpy(spatial_obs.copy()).cpu()
-            non_spatial_obs = torch.from_numpy(non_spatial_obs.copy()).cpu()
-            action_mask = torch.from_numpy(action_mask.copy()).cpu()
-            remote.send((spatial_obs, non_spatial_obs, action_mask, reward, tds_scored, tds_opp_scored, done))
+            slots, actions, dif = data
+            results = [runners[slot].step(action, dif) for slot, action in zip(slots, actions)]
         elif command == 'reset':
-            steps = 0
-            tds = 0
-            tds_opp = 0
-            env.root_env.away_agent = next_opp
-            spatial_obs, non_spatial_obs, action_mask = env.reset()
-            remote.send((spatial_obs, non_spatial_obs, action_mask, 0.0, 0, 0, False))
+            slots = range(len(runners))
+            results = [runner.reset() for runner in runners]
         elif command == 'swap':
-            if sct and num_steps * scripted_rate > steps:
-                next_opp = botbowl.make_bot('scripted')
-            else:
-                next_opp = data
+            for runner in runners:
+                runner.swap(data, inference_client)
+            continue
         elif command == 'close':
             break
+        else:
+            continue
+        if buffers is not None:
+            for slot, result in zip(slots, results):
+                buffers.write(env_ids[slot], *result)
+            remote.send(None)
+        else:
+            remote.send(tuple(map(np.stack, zip(*results))))
 
 
 class VecEnv:
-    def __init__(self, envs):
+    def __init__(self, envs, inference_server: Optional[InferenceServer] = None,
+                 buffers: Optional[SharedObsBuffers] = None, envs_per_worker=1):
         self.closed = False
         nenvs = len(envs)
-        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
-        self.ps = [Process(target=worker, args=(work_remote, remote, env, envs.index(env)))
-                   for (work_remote, remote, env) in zip(self.work_remotes, self.remotes, envs)]
+        self.worker_env_ids = [list(range(i, min(i + envs_per_worker, nenvs))) for i in range(0, nenvs, envs_per_worker)]
+        self.env_workers = [worker_id for worker_id, env_ids in enumerate(self.worker_env_ids) for _ in env_ids]
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in self.worker_env_ids])
+        self.pending = {}
+        inference_clients = [inference_server.get_client(i) if inference_server is not None else None
+                             for i in range(len(self.worker_env_ids))]
+        self.ps = [Process(target=worker,
+                           args=(work_remote, remote, [envs[i] for i in env_ids], env_ids, inference_client, buffers))
+                   for (work_remote, remote, env_ids, inference_client)
+                   in zip(self.work_remotes, self.remotes, self.worker_env_ids, inference_clients)]
         for p in self.ps:
             p.daemon = True
             p.start()
@@ -176,16 +698,59 @@ class VecEnv:
             remote.close()
 
     def step(self, actions: Iterable[int], difficulty=1.0) -> Tuple[np.ndarray, ...]:
-        for remote, action in zip(self.remotes, actions):
-            remote.send(('step', [action, difficulty]))
+        self.step_async(range(self.num_envs), actions, difficulty)
         results = [remote.recv() for remote in self.remotes]
-        return tuple(map(np.stack, zip(*results)))
+        self.pending.clear()
+        return tuple(map(np.concatenate, zip(*results)))
 
     def reset(self, difficulty=1.0):
         for remote in self.remotes:
             remote.send(('reset', difficulty))
         results = [remote.recv() for remote in self.remotes]
-        return tuple(map(np.stack, zip(*results)))
+        return tuple(map(np.concatenate, zip(*results)))
+
+    def step_async(self, env_ids: Iterable[int], actions: Iterable[int], difficulty=1.0):
+        actions_by_worker = defaultdict(list)
+        for env_id, action in zip(env_ids, actions):
+            actions_by_worker[self.env_workers[env_id]].append((env_id, action))
+        for worker_id, env_actions in actions_by_worker.items():
+            worker_env_ids, worker_actions = zip(*env_actions)
+            slots = [env_id - self.worker_env_ids[worker_id][0] for env_id in worker_env_ids]
+            self.remotes[worker_id].send(('step', [slots, worker_actions, difficulty]))
+            self.pending[worker_id] = list(worker_env_ids)
+
+    def step_wait(self, min_batch_size=None, timeout=None) -> Tuple[np.ndarray, Tuple[np.ndarray, ...]]:
+        """
+        Waits for at least min_batch_size of the pending envs, or for any pending env once timeout seconds have
+        passed, and returns the ids of the envs that finished together with their stacked results. Envs hosted
+        by the same worker always finish together.
+        """
+        min_batch_size = self.num_pending if min_batch_size is None else min(min_batch_size, self.num_pending)
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        env_ids = []
+        results = []
+        while len(self.pending) > 0:
+            if len(env_ids) >= min_batch_size:
+                wait_time = 0
+            elif deadline is not None and len(env_ids) > 0:
+                wait_time = max(0.0, deadline - time.perf_counter())
+            else:
+                wait_time = None
+            ready = wait([self.remotes[worker_id] for worker_id in self.pending], wait_time)
+            if len(ready) == 0:
+                break
+            for remote in ready:
+                env_ids.extend(self.pending.pop(self.remotes.index(remote)))
+                results.append(remote.recv())
+        env_ids = np.array(env_ids)
+        return env_ids, self._gather(env_ids, results)
+
+    def _gather(self, env_ids, results):
+        return tuple(map(np.concatenate, zip(*results)))
+
+    @property
+    def num_pending(self):
+        return sum(len(env_ids) for env_ids in self.pending.values())
 
     def swap(self, agent):
         for remote in self.remotes:
@@ -202,22 +767,61 @@ class VecEnv:
 
     @property
     def num_envs(self):
-        return len(self.remotes)
+        return len(self.env_workers)
+
+
+class SharedMemoryVecEnv(VecEnv):
+    """
+    VecEnv backend where the workers write their results straight into shared memory buffers and only signal
+    completion over the pipes. The returned arrays are views of the buffers and are overwritten by the next call.
+    """
+    def __init__(self, envs, spatial_obs_shape, non_spatial_obs_shape, action_space,
+                 inference_server: Optional[InferenceServer] = None, envs_per_worker=1):
+        self.buffers = SharedObsBuffers(len(envs), spatial_obs_shape, non_spatial_obs_shape, action_space)
+        super().__init__(envs, inference_server, self.buffers, envs_per_worker)
+
+    def step(self, actions: Iterable[int], difficulty=1.0) -> Tuple[np.ndarray, ...]:
+        self.step_async(range(self.num_envs), actions, difficulty)
+        for remote in self.remotes:
+            remote.recv()
+        self.pending.clear()
+        return self.buffers.read()
+
+    def reset(self, difficulty=1.0):
+        for remote in self.remotes:
+            remote.send(('reset', difficulty))
+        for remote in self.remotes:
+            remote.recv()
+        return self.buffers.read()
+
+    def _gather(self, env_ids, results):
+        return tuple(buffer[env_ids] for buffer in self.buffers.read())
+
+
+def make_opponent(model_name, model_path):
+    if use_inference_server:
+        return model_name, model_path
+    return make_agent_from_model(name=model_name, filename=model_path)
 
 
 def main():
-    envs = VecEnv([make_env() for _ in range(num_processes)])
     env = make_env()
     spat_obs, non_spat_obs, action_mask = env.reset()
     spatial_obs_space = spat_obs.shape
     non_spatial_obs_space = non_spat_obs.shape[0]
     action_space = len(action_mask)
     del env, non_spat_obs, action_mask
+    inference_server = InferenceServer(num_processes) if use_inference_server else None
+    if shared_memory_obs:
+        envs = SharedMemoryVecEnv([make_env() for _ in range(num_processes)], spatial_obs_space,
+                                  (non_spatial_obs_space,), action_space, inference_server, envs_per_worker)
+    else:
+        envs = VecEnv([make_env() for _ in range(num_processes)], inference_server, envs_per_worker=envs_per_worker)
     if uom:
         model_path = os.path.join(model_dir, old_model)
         if os.path.exists(model_path):
             print(f"Loading existing model from {model_path}")
-            ac_agent = torch.load(model_path)
+            ac_agent = torch.load(model_path, map_location=device)
         else:
             print("Error in loading old model process!")
     else:
@@ -226,11 +830,14 @@ def main():
                              non_spatial_obs_space,
                              hidden_nodes=num_hidden_nodes,
                              kernels=num_cnn_kernels,
-                             actions=action_space).cuda()
+                             actions=action_space).to(device)
 
     optimizer = optim.RMSprop(ac_agent.parameters(), learning_rate)
-    memory = Memory(steps_per_update, num_processes, spatial_obs_space, (1, non_spatial_obs_space), action_space)
-    memory.cuda()
+    memory = Memory(steps_per_update, num_processes, spatial_obs_space, (1, non_spatial_obs_space), action_space,
+                    compact=compact_memory)
+    memory.to(device)
+    memory_used, memory_full = memory.nbytes()
+    print(f"Rollout storage: {memory_used / 2 ** 20:.1f} MB of {memory_full / 2 ** 20:.1f} MB uncompressed")
     difficulty = 0.0 if ppcg else 1.0
     dif_delta = 0.01
     all_updates = 0
@@ -262,36 +869,29 @@ def main():
         model_name = f"{exp_id}_selfplay_0.nn"
         model_path = os.path.join(model_dir, model_name)
         torch.save(ac_agent, model_path)
-        self_play_agent = make_agent_from_model(name=model_name, filename=model_path)
-
-        envs.swap(self_play_agent)
+        envs.swap(make_opponent(model_name, model_path))
         selfplay_models += 1
 
     spatial_obs, non_spatial_obs, action_masks, _, _, _, _ = map(torch.from_numpy, envs.reset(difficulty))
     non_spatial_obs = torch.unsqueeze(non_spatial_obs, dim=1)
-    memory.spatial_obs[0].copy_(spatial_obs)
-    memory.non_spatial_obs[0].copy_(non_spatial_obs)
-    memory.action_masks[0].copy_(action_masks)
+    memory.spatial_obs[0] = spatial_obs.float()
+    memory.non_spatial_obs[0] = non_spatial_obs.float()
+    memory.action_masks[0] = action_masks
+    transfers = TransferPipeline(num_processes, spatial_obs_space, (1, non_spatial_obs_space), action_space)
 
-    while all_steps < num_steps:
-        for step in range(steps_per_update):
-            _, actions = ac_agent.act(
-                Variable(memory.spatial_obs[step].cuda()),
-                Variable(memory.non_spatial_obs[step].cuda()),
-                Variable(memory.action_masks[step].cuda())
-            )
+    # In impala mode the actor thread records results while this thread reads and resets them
+    results_lock = threading.Lock()
 
-            action_objects = (action[0] for action in actions.cpu().numpy())
-            spatial_obs, non_spatial_obs, action_masks, shaped_reward, tds_scored, tds_opp_scored, done = envs.step(
-                action_objects, difficulty=difficulty)
-
-            proc_rewards += shaped_reward
-            proc_tds += tds_scored
-            proc_tds_opp += tds_opp_scored
+    def record_results(env_ids, shaped_reward, tds_scored, tds_opp_scored, done):
+        nonlocal difficulty, episodes
+        with results_lock:
+            proc_rewards[env_ids] += shaped_reward
+            proc_tds[env_ids] += tds_scored
+            proc_tds_opp[env_ids] += tds_opp_scored
             episodes += done.sum()
 
-            for i in range(num_processes):
-                if done[i]:
+            for i, done_ in zip(env_ids, done):
+                if done_:
                     if proc_tds[i] > proc_tds_opp[i]:
                         wins.append(1)
                         difficulty += dif_delta
@@ -311,36 +911,93 @@ def main():
                     proc_rewards[i] = 0
                     proc_tds[i] = 0
                     proc_tds_opp[i] = 0
-            masks = torch.FloatTensor([[0.0] if done_ else [1.0] for done_ in done])
-            memory.insert(step, spatial_obs, non_spatial_obs, actions.data, shaped_reward, masks, action_masks)
-
-        next_value = ac_agent(Variable(memory.spatial_obs[-1], requires_grad=False),
-                              Variable(memory.non_spatial_obs[-1], requires_grad=False))[0].data
-
-        memory.compute_returns(next_value, gamma)
-        spatial = Variable(memory.spatial_obs[:-1])
-        spatial = spatial.view(-1, *spatial_obs_space)
-        non_spatial = Variable(memory.non_spatial_obs[:-1])
-        non_spatial = non_spatial.view(-1, non_spatial.shape[-1])
-        actions = Variable(memory.actions.view(-1, 1).long().cuda())
-        actions_mask = Variable(memory.action_masks[:-1])
-        action_log_probs, values, dist_entropy = ac_agent.evaluate_actions(spatial, non_spatial, actions, actions_mask)
-        values = values.view(steps_per_update, num_processes, 1)
-        action_log_probs = action_log_probs.view(steps_per_update, num_processes, 1)
-        advantages = Variable(memory.returns[:-1]) - values
-        value_loss = advantages.pow(2).mean()
-        action_loss = -(Variable(advantages.data) * action_log_probs).mean()
-        optimizer.zero_grad()
-        total_loss = (value_loss * value_loss_coef + action_loss - dist_entropy * entropy_coef)
-        total_loss.backward()
-        nn.utils.clip_grad_norm_(ac_agent.parameters(), max_grad_norm)
-        optimizer.step()
-        memory.non_spatial_obs[0].copy_(memory.non_spatial_obs[-1])
-        memory.spatial_obs[0].copy_(memory.spatial_obs[-1])
-        memory.action_masks[0].copy_(memory.action_masks[-1])
+
+    def swap_opponent(opponent):
+        if actor is not None:
+            actor.swaps.put(opponent)
+        else:
+            envs.swap(opponent)
+
+    actor = None
+    policy_lag = []
+    if training_mode == 'impala':
+        memories = [memory]
+        for _ in range(impala_queue_size + 1):
+            memories.append(Memory(steps_per_update, num_processes, spatial_obs_space, (1, non_spatial_obs_space),
+                                   action_space, compact=compact_memory))
+            memories[-1].to(device)
+        actor = ImpalaActor(envs, ac_agent, memories, transfers, record_results, lambda: difficulty)
+        actor.start()
+
+    all_env_ids = np.arange(num_processes)
+    start_time = time.perf_counter()
+    while all_steps < num_steps:
+        if actor is not None:
+            memory = actor.get_rollout()
+        elif async_envs:
+            # Every env advances through its own column of the rollout, acting as soon as its last step returns
+            env_steps = torch.zeros(num_processes, dtype=torch.long)
+            pending_actions = torch.zeros(num_processes, 1, dtype=torch.long, device=device)
+            pending_values = torch.zeros(num_processes, 1, device=device)
+            pending_log_probs = torch.zeros(num_processes, 1, device=device)
+            idle = torch.arange(num_processes)
+            while len(idle) > 0 or envs.num_pending > 0:
+                if len(idle) > 0:
+                    with torch.no_grad():
+                        values, actions, action_log_probs = ac_agent.act_with_log_probs(
+                            memory.spatial_obs[env_steps[idle], idle],
+                            memory.non_spatial_obs[env_steps[idle], idle],
+                            memory.action_masks[env_steps[idle], idle]
+                        )
+                    pending_actions[idle] = actions
+                    pending_values[idle] = values
+                    pending_log_probs[idle] = action_log_probs
+                    envs.step_async(idle.tolist(), (action[0] for action in actions.cpu().numpy()), difficulty)
+                env_ids, results = envs.step_wait(async_min_batch_size, async_timeout)
+                spatial_obs, non_spatial_obs, action_masks, shaped_reward, tds_scored, tds_opp_scored, done = results
+                spatial_obs, non_spatial_obs, action_masks, rewards, masks = transfers.stage(
+                    spatial_obs, non_spatial_obs, action_masks, shaped_reward, done)
+                record_results(env_ids, shaped_reward, tds_scored, tds_opp_scored, done)
+                env_ids = torch.from_numpy(env_ids)
+                memory.insert(env_steps[env_ids], spatial_obs, non_spatial_obs, pending_actions[env_ids],
+                              rewards, masks, action_masks, pending_values[env_ids], env_ids=env_ids,
+                              action_log_prob=pending_log_probs[env_ids])
+                env_steps[env_ids] += 1
+                idle = env_ids[env_steps[env_ids] < steps_per_update]
+        else:
+            for step in range(steps_per_update):
+                with torch.no_grad():
+                    values, actions, action_log_probs = ac_agent.act_with_log_probs(
+                        memory.spatial_obs[step],
+                        memory.non_spatial_obs[step],
+                        memory.action_masks[step]
+                    )
+
+                action_objects = (action[0] for action in actions.cpu().numpy())
+                spatial_obs, non_spatial_obs, action_masks, shaped_reward, tds_scored, tds_opp_scored, done = envs.step(
+                    action_objects, difficulty=difficulty)
+
+                spatial_obs, non_spatial_obs, action_masks, rewards, masks = transfers.stage(
+                    spatial_obs, non_spatial_obs, action_masks, shaped_reward, done)
+                record_results(all_env_ids, shaped_reward, tds_scored, tds_opp_scored, done)
+                memory.insert(step, spatial_obs, non_spatial_obs, actions, rewards, masks, action_masks, values,
+                              action_log_prob=action_log_probs)
+
+        if actor is not None:
+            vtrace_update(ac_agent, optimizer, memory)
+            policy_lag.append(all_updates - memory.policy_version)
+            actor.release(memory)
+            actor.sync(ac_agent)
+        elif training_mode == 'ppo':
+            ppo_update(ac_agent, optimizer, memory)
+            memory.roll_over()
+        else:
+            a2c_update(ac_agent, optimizer, memory)
+            memory.roll_over()
         all_updates += 1
-        all_episodes += episodes
-        episodes = 0
+        with results_lock:
+            all_episodes += episodes
+            episodes = 0
         all_steps += num_processes * steps_per_update
 
         if selfplay and all_steps >= selfplay_next_save:
@@ -358,17 +1015,20 @@ def main():
             model_name = f"{exp_id}_selfplay_{i}.nn"
             model_path = os.path.join(model_dir, model_name)
             print(f"Swapping opponent to {model_path}")
-            envs.swap(make_agent_from_model(name=model_name, filename=model_path))
+            swap_opponent(make_opponent(model_name, model_path))
+            stats = model_registry.get_stats()
+            print(f"Model loads/hits: {stats['loads']}/{stats['hits']}, time saved: {stats['time_saved']:.2f}s")
 
         if all_updates % log_interval == 0 and len(episode_rewards) >= num_processes:
-            td_rate = np.mean(episode_tds)
-            td_rate_opp = np.mean(episode_tds_opp)
-            episode_tds.clear()
-            episode_tds_opp.clear()
-            mean_reward = np.mean(episode_rewards)
-            episode_rewards.clear()
-            win_rate = np.mean(wins)
-            wins.clear()
+            with results_lock:
+                td_rate = np.mean(episode_tds)
+                td_rate_opp = np.mean(episode_tds_opp)
+                episode_tds.clear()
+                episode_tds_opp.clear()
+                mean_reward = np.mean(episode_rewards)
+                episode_rewards.clear()
+                win_rate = np.mean(wins)
+                wins.clear()
             log_updates.append(all_updates)
             log_episode.append(all_episodes)
             log_steps.append(all_steps)
@@ -390,7 +1050,12 @@ def main():
                 myfile.write(log_to_file)
 
             print(log)
-            episodes = 0
+            if actor is not None:
+                elapsed = time.perf_counter() - start_time
+                print(f"Actor waiting: {actor.actor_wait_time / elapsed:.0%}, "
+                      f"learner waiting: {actor.learner_wait_time / elapsed:.0%}, "
+                      f"mean policy lag: {np.mean(policy_lag):.2f} updates")
+                policy_lag.clear()
             value_losses.clear()
             policy_losses.clear()
             model_name = f"{exp_id}.nn"
@@ -431,8 +1096,12 @@ def main():
     model_name = f"{exp_id}.nn"
     model_path = os.path.join(model_dir, model_name)
     torch.save(ac_agent, model_path)
+    if actor is not None:
+        actor.stop()
     envs.close()
+    if inference_server is not None:
+        inference_server.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,66 @@
+from collections import deque
+
+from botbowl import Game
+
+
+class ActionQueue:
+    """
+    Planned actions with O(1) pops. A plan is everything queued while the queue was empty, and the rest of it is
+    thrown away when the game rejects one of its actions, since it was planned on the same assumptions.
+    """
+    def __init__(self):
+        self.actions = deque()
+        self.plans = 0
+        self.discarded_plans = 0
+        self.planned_actions = 0
+        self.discarded_actions = 0
+
+    def __len__(self):
+        return len(self.actions)
+
+    def append(self, action):
+        if len(self.actions) == 0:
+            self.plans += 1
+        self.planned_actions += 1
+        self.actions.append(action)
+
+    def extend(self, actions):
+        for action in actions:
+            self.append(action)
+
+    def popleft(self):
+        return self.actions.popleft()
+
+    def pop_allowed(self, game: Game):
+        """
+        Returns the next action if the game allows it, otherwise invalidates the plan and returns None.
+        """
+        action = self.actions.popleft()
+        if game._is_action_allowed(action):
+            return action
+        self.discarded_plans += 1
+        self.discarded_actions += 1 + len(self.actions)
+        self.actions.clear()
+        return None
+
+    def clear(self):
+        if len(self.actions) > 0:
+            self.discarded_plans += 1
+            self.discarded_actions += len(self.actions)
+            self.actions.clear()
+
+    def reset_stats(self):
+        self.plans = 0
+        self.discarded_plans = 0
+        self.planned_actions = 0
+        self.discarded_actions = 0
+
+    def get_stats(self):
+        return {
+            'plans': self.plans,
+            'discarded_plans': self.discarded_plans,
+            'plan_discard_rate': self.discarded_plans / self.plans if self.plans > 0 else 0.0,
+            'planned_actions': self.planned_actions,
+            'discarded_actions': self.discarded_actions,
+            'action_discard_rate': self.discarded_actions / self.planned_actions if self.planned_actions > 0 else 0.0
+        }
@@ -1,7 +1,17 @@
+import json
+import math
+import os
+import time
+from collections import OrderedDict, namedtuple
+from multiprocessing import Pool
+
+import numpy as np
+import torch
 import botbowl
 from botbowl import EnvConf
 from implementation.a2c.a2c_agent import A2CAgent
 from implementation.a2c.a2c_env import a2c_scripted_actions
+from implementation.model_registry import model_registry
 
 model_name = 'long'
 model_name_opponent = 'balance'
@@ -9,68 +19,321 @@ env_name = f'botbowl-11'
 model_filename = f"models/{env_name}/{model_name}.nn"
 model_filename_opponent = f"models/{env_name}/{model_name_opponent}.nn"
 log_filename = f"logs/{env_name}/{env_name}.dat"
+results_filename = f"logs/{env_name}/competition_{model_name}_vs_{model_name_opponent}.bin"
 num_games = 100000
+num_workers = os.cpu_count()
+games_per_task = 16
+base_seed = 0
+alternate_home = False
+device = 'cpu'
+worker_threads = 1
+max_worker_agents = 4
+log_interval = 1000
+early_stopping = False
+min_games = 200
+confidence_z = 1.96
+target_precision = 0.005
+sprt_elo = 10
+sprt_alpha = 0.05
+sprt_beta = 0.05
 
+GameResult = namedtuple('GameResult', ['game_id', 'seed', 'is_home', 'winner', 'tds', 'tds_opponent', 'duration'])
 
-def main():
-    def _make_my_a2c_bot(name, env_size=11):
-        return A2CAgent(name=name,
-                        env_conf=EnvConf(size=env_size),
-                        scripted_func=a2c_scripted_actions,
-                        filename=model_filename)
-    botbowl.register_bot('bot', _make_my_a2c_bot)
-
-    def _make_my_a2c_bot_opponent(name, env_size=11):
-        return A2CAgent(name=name,
-                        env_conf=EnvConf(size=env_size),
-                        scripted_func=a2c_scripted_actions,
-                        filename=model_filename_opponent)
-    botbowl.register_bot('bot-opponent', _make_my_a2c_bot_opponent)
-
-
-    config = botbowl.load_config("bot-bowl")
-    config.competition_mode = False
-    config.pathfinding_enabled = False
-    ruleset = botbowl.load_rule_set(config.ruleset)
-    arena = botbowl.load_arena(config.arena)
-    home = botbowl.load_team_by_filename("human", ruleset)
-    away = botbowl.load_team_by_filename("human", ruleset)
-    config.competition_mode = False
-    config.debug_mode = False
-
-    wins = 0
-    draws = 0
-    n = num_games
-    is_home = True
-    tds_away = 0
-    tds_home = 0
-    for i in range(n):
+RESULT_DTYPE = np.dtype([('game_id', '<i8'), ('seed', '<i8'), ('is_home', '?'), ('winner', 'i1'),
+                         ('tds', '<i2'), ('tds_opponent', '<i2'), ('duration', '<f4')])
+WINNER_CODES = {'bot': 1, None: 0, 'bot-opponent': -1}
+WINNERS = {code: winner for winner, code in WINNER_CODES.items()}
+
+_worker = None
+
+
+class TournamentWorker:
+    """
+    Everything a pool process needs to play games: agents are kept in an LRU of max_worker_agents, enough for the
+    matchup in flight plus the last one, so a league over many checkpoints doesn't keep them all in memory.
+    """
+    def __init__(self, env_size=11):
+        self.env_size = env_size
+        self.config = botbowl.load_config("bot-bowl")
+        self.config.competition_mode = False
+        self.config.pathfinding_enabled = False
+        self.config.debug_mode = False
+        self.ruleset = botbowl.load_rule_set(self.config.ruleset)
+        self.arena = botbowl.load_arena(self.config.arena)
+        self.home = botbowl.load_team_by_filename("human", self.ruleset)
+        self.away = botbowl.load_team_by_filename("human", self.ruleset)
+        self.agents = OrderedDict()
+
+    def get_agent(self, name, filename):
+        key = (name, filename)
+        if key in self.agents:
+            self.agents.move_to_end(key)
+            return self.agents[key]
+        agent = self.agents[key] = A2CAgent(name=name,
+                                            env_conf=EnvConf(size=self.env_size),
+                                            scripted_func=a2c_scripted_actions,
+                                            filename=filename,
+                                            device=device)
+        if len(self.agents) > max_worker_agents:
+            (_, evicted_filename), _ = self.agents.popitem(last=False)
+            if all(cached_filename != evicted_filename for _, cached_filename in self.agents):
+                model_registry.release(evicted_filename, device)
+        return agent
 
+    def play(self, game_id, filename=model_filename, filename_opponent=model_filename_opponent,
+             alternate=alternate_home):
+        agent = self.get_agent('bot', filename)
+        agent_opponent = self.get_agent('bot-opponent', filename_opponent)
+        seed = base_seed + game_id
+        is_home = not alternate or game_id % 2 == 0
         if is_home:
-            away_agent = botbowl.make_bot('bot-opponent')
-            home_agent = botbowl.make_bot('bot')
+            home_agent, away_agent = agent, agent_opponent
         else:
-            away_agent = botbowl.make_bot('bot')
-            home_agent = botbowl.make_bot("bot-opponent")
-        game = botbowl.Game(i, home, away, home_agent, away_agent, config, arena=arena, ruleset=ruleset)
+            home_agent, away_agent = agent_opponent, agent
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        start = time.perf_counter()
+        game = botbowl.Game(game_id, self.home, self.away, home_agent, away_agent, self.config,
+                            arena=self.arena, ruleset=self.ruleset, seed=seed)
         game.config.fast_mode = True
-
         game.init()
 
         winner = game.get_winner()
         if winner is None:
-            draws += 1
-        elif winner == home_agent and is_home:
-            wins += 1
-        elif winner == away_agent and not is_home:
-            wins += 1
+            result = None
+        else:
+            result = 'bot' if winner == agent else 'bot-opponent'
+        return GameResult(game_id, seed, is_home, result,
+                          game.get_agent_team(agent).state.score,
+                          game.get_agent_team(agent_opponent).state.score,
+                          time.perf_counter() - start)
+
+
+def _init_worker():
+    global _worker
+    torch.set_num_threads(worker_threads)
+    _worker = TournamentWorker()
+
+
+def _play_game(task):
+    return task, _worker.play(*task)
+
+
+def make_pool(workers=num_workers):
+    return Pool(workers, initializer=_init_worker)
+
+
+def play_games(pool, tasks):
+    """
+    Plays (game_id, filename, filename_opponent, alternate) tasks on the pool and yields (task, GameResult) as
+    soon as each game is finished, so not in task order. Results only depend on the tasks, not on the workers.
+    """
+    return pool.imap_unordered(_play_game, tasks, chunksize=games_per_task)
+
+
+def run_tournament(game_ids, filename=model_filename, filename_opponent=model_filename_opponent,
+                   workers=num_workers):
+    with make_pool(workers) as pool:
+        tasks = [(game_id, filename, filename_opponent, alternate_home) for game_id in game_ids]
+        for _, result in play_games(pool, tasks):
+            yield result
+
+
+class EvaluationStats:
+    """
+    Running win/draw/loss counts and TD differential of the bot against its opponent, with a confidence
+    interval on the score (win 1, draw 0.5, loss 0) and a sequential probability ratio test between an elo
+    difference of -sprt_elo and +sprt_elo, using the normal approximation of the score distribution.
+    """
+    def __init__(self):
+        self.n = 0
+        self.wins = 0
+        self.draws = 0
+        self.tds = 0
+        self.tds_opponent = 0
+        self.td_diff_sq = 0
+        self.duration = 0.0
+
+    @property
+    def losses(self):
+        return self.n - self.wins - self.draws
+
+    def update(self, result: GameResult):
+        self.n += 1
+        if result.winner is None:
+            self.draws += 1
+        elif result.winner == 'bot':
+            self.wins += 1
+        self.tds += result.tds
+        self.tds_opponent += result.tds_opponent
+        self.td_diff_sq += (result.tds - result.tds_opponent) ** 2
+        self.duration += result.duration
+
+    def score(self):
+        return (self.wins + 0.5 * self.draws) / self.n
+
+    def score_variance(self):
+        # Per-game variance of the score
+        return (self.wins + 0.25 * self.draws) / self.n - self.score() ** 2
+
+    def confidence_interval(self, z=confidence_z):
+        half_width = z * math.sqrt(self.score_variance() / self.n)
+        return self.score() - half_width, self.score() + half_width
+
+    def td_diff(self):
+        return (self.tds - self.tds_opponent) / self.n
+
+    def td_diff_interval(self, z=confidence_z):
+        variance = self.td_diff_sq / self.n - self.td_diff() ** 2
+        half_width = z * math.sqrt(variance / self.n)
+        return self.td_diff() - half_width, self.td_diff() + half_width
+
+    def llr(self, elo=sprt_elo):
+        variance = self.score_variance()
+        if variance <= 0:
+            return 0.0
+        score0 = 1 / (1 + 10 ** (elo / 400))
+        score1 = 1 - score0
+        return self.n * (score1 - score0) * (2 * self.score() - score0 - score1) / (2 * variance)
+
+    def stop_reason(self):
+        """
+        Why the evaluation can stop after these games, or None if it should go on.
+        """
+        if self.n < min_games:
+            return None
+        llr = self.llr()
+        if llr >= math.log((1 - sprt_beta) / sprt_alpha):
+            return f"SPRT accepted bot +{sprt_elo} elo over -{sprt_elo} elo"
+        if llr <= math.log(sprt_beta / (1 - sprt_alpha)):
+            return f"SPRT accepted bot -{sprt_elo} elo over +{sprt_elo} elo"
+        low, high = self.confidence_interval()
+        if (high - low) / 2 <= target_precision:
+            return "precision reached"
+        return None
+
+    def report(self):
+        low, high = self.confidence_interval()
+        td_low, td_high = self.td_diff_interval()
+        print(f"Wins/Draws/Losses: {self.wins}/{self.draws}/{self.losses}")
+        print(f"Score: {self.score():.3f} [{low:.3f}, {high:.3f}], LLR: {self.llr():.2f}")
+        print(f"TDs per game: {self.tds/self.n}")
+        print(f"Opponent TDs per game: {self.tds_opponent/self.n}")
+        print(f"TD differential: {self.td_diff():.3f} [{td_low:.3f}, {td_high:.3f}]")
+        print(f"Game duration: {self.duration/self.n:.2f}s")
+
+
+class ResultsFile:
+    """
+    Append-only file of fixed-width RESULT_DTYPE records, one per finished game, flushed as they come in. A
+    record cut short by a crash is dropped when the file is read back. The optional header (models, settings) is
+    kept in a JSON file next to it, so results aren't resumed under different conditions.
+    """
+    def __init__(self, filename, header=None):
+        self.filename = filename
+        self.header_filename = filename + '.json'
+        self.header = header
+        self.file = None
+
+    def header_matches(self):
+        if not os.path.exists(self.filename) or self.header is None:
+            return True
+        if not os.path.exists(self.header_filename):
+            return False
+        with open(self.header_filename) as f:
+            return json.load(f) == self.header
+
+    def remove(self):
+        for filename in [self.filename, self.header_filename]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def read(self):
+        if not os.path.exists(self.filename):
+            return []
+        num_records = os.path.getsize(self.filename) // RESULT_DTYPE.itemsize
+        records = np.fromfile(self.filename, dtype=RESULT_DTYPE, count=num_records)
+        return [GameResult(int(record['game_id']), int(record['seed']), bool(record['is_home']),
+                           WINNERS[int(record['winner'])], int(record['tds']), int(record['tds_opponent']),
+                           float(record['duration'])) for record in records]
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        if self.header is not None and not os.path.exists(self.filename):
+            with open(self.header_filename, 'w') as f:
+                json.dump(self.header, f)
+        if os.path.exists(self.filename):
+            # Drop a partially written last record
+            size = os.path.getsize(self.filename)
+            if size % RESULT_DTYPE.itemsize != 0:
+                os.truncate(self.filename, size - size % RESULT_DTYPE.itemsize)
+        self.file = open(self.filename, 'ab')
+
+    def append(self, result: GameResult):
+        record = np.array([(result.game_id, result.seed, result.is_home, WINNER_CODES[result.winner],
+                            result.tds, result.tds_opponent, result.duration)], dtype=RESULT_DTYPE)
+        self.file.write(record.tobytes())
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def results_header():
+    return {'model_filename': model_filename, 'model_mtime': os.path.getmtime(model_filename),
+            'model_filename_opponent': model_filename_opponent,
+            'model_mtime_opponent': os.path.getmtime(model_filename_opponent),
+            'base_seed': base_seed, 'alternate_home': alternate_home}
+
+
+def main():
+    stats = EvaluationStats()
+    results_file = ResultsFile(results_filename, results_header())
+    if not results_file.header_matches():
+        print(f"{results_filename} was written for other models or settings, remove it or change results_filename")
+        return
+    # Results wait here until every earlier game has finished, so the stats only see games in scheduling order.
+    # Stopping on whichever games finish first would favour the short ones.
+    finished = {result.game_id: result for result in results_file.read()}
+    if len(finished) > 0:
+        print(f"Resuming from {results_filename} with {len(finished)} completed games")
+    game_ids = [i for i in range(num_games) if i not in finished]
+    next_game_id = 0
+    while next_game_id in finished:
+        stats.update(finished.pop(next_game_id))
+        next_game_id += 1
 
-        tds_home += game.get_agent_team(home_agent).state.score
-        tds_away += game.get_agent_team(away_agent).state.score
+    start = time.perf_counter()
+    reason = stats.stop_reason() if early_stopping else None
+    played = 0
+    results_file.open()
+    try:
+        results = run_tournament(game_ids) if reason is None and len(game_ids) > 0 else []
+        for result in results:
+            results_file.append(result)
+            finished[result.game_id] = result
+            played += 1
+            while reason is None and next_game_id in finished:
+                stats.update(finished.pop(next_game_id))
+                next_game_id += 1
+                if stats.n % log_interval == 0:
+                    low, high = stats.confidence_interval()
+                    print(f"{stats.n}/{num_games} games, {played / (time.perf_counter() - start):.1f} games/s, "
+                          f"score {stats.score():.3f} [{low:.3f}, {high:.3f}], LLR {stats.llr():.2f}")
+                if early_stopping:
+                    reason = stats.stop_reason()
+            if reason is not None:
+                break
+    finally:
+        results_file.close()
 
-    print(f"Home/Draws/Away: {wins}/{draws}/{n-wins-draws}")
-    print(f"Home TDs per game: {tds_home/n}")
-    print(f"Away TDs per game: {tds_away/n}")
+    if reason is not None:
+        print(f"Stopped after {stats.n} games: {reason}")
+    if stats.n > 0:
+        stats.report()
+    print(f"Wall time: {time.perf_counter() - start:.0f}s")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,152 @@
+import glob
+import itertools
+import math
+import os
+import time
+
+import numpy as np
+from implementation.competition import EvaluationStats, ResultsFile, make_pool, play_games, num_workers
+
+env_name = f'botbowl-11'
+league_model_dir = f"models/{env_name}/"
+league_results_dir = f"logs/{env_name}/league/"
+games_per_round = 32
+pairs_per_round = 8
+max_league_games = 20000
+target_stderr = 0.03
+rating_iterations = 100
+prior_games = 1.0
+
+
+def find_checkpoints(model_dir=league_model_dir):
+    # Only the frozen self-play snapshots, not the rolling {exp_id}.nn the trainer keeps overwriting
+    return sorted(glob.glob(os.path.join(model_dir, "*_selfplay_*.nn")), key=os.path.getmtime)
+
+
+def fit_ratings(num_models, pair_stats):
+    """
+    Elo ratings (mean 0) of the Bradley-Terry model fitted to the pairwise scores, with draws counted as half
+    a win and prior_games virtual draws per played pair so that perfect records stay finite.
+    """
+    strengths = np.ones(num_models)
+    for _ in range(rating_iterations):
+        scores = np.zeros(num_models)
+        denominators = np.zeros(num_models)
+        for (i, j), stats in pair_stats.items():
+            if stats.n == 0:
+                continue
+            n = stats.n + prior_games
+            score = stats.wins + 0.5 * stats.draws + 0.5 * prior_games
+            scores[i] += score
+            scores[j] += n - score
+            denominators[i] += n / (strengths[i] + strengths[j])
+            denominators[j] += n / (strengths[i] + strengths[j])
+        played = denominators > 0
+        strengths[played] = scores[played] / denominators[played]
+        strengths /= np.exp(np.mean(np.log(strengths)))
+    return 400 * np.log10(strengths)
+
+
+def expected_score(rating, rating_opponent):
+    return 1 / (1 + 10 ** ((rating_opponent - rating) / 400))
+
+
+def pair_priority(stats, ratings, i, j):
+    """
+    Standard error of the pair's score, weighted by how close the pair is rated, as close pairs decide the
+    ranking. Unplayed pairs have the largest standard error.
+    """
+    score = (stats.wins + 0.5 * stats.draws + 1) / (stats.n + 2)
+    stderr = math.sqrt(score * (1 - score) / (stats.n + 2))
+    expected = expected_score(ratings[i], ratings[j])
+    return stderr * 4 * expected * (1 - expected), stderr
+
+
+def load_pair(checkpoints, i, j):
+    name = os.path.basename(checkpoints[i])[:-3]
+    name_opponent = os.path.basename(checkpoints[j])[:-3]
+    header = {checkpoint: [os.path.getmtime(checkpoint), os.path.getsize(checkpoint)]
+              for checkpoint in [checkpoints[i], checkpoints[j]]}
+    results_file = ResultsFile(os.path.join(league_results_dir, f"{name}_vs_{name_opponent}.bin"), header)
+    if not results_file.header_matches():
+        # A checkpoint was rewritten since these games were played
+        results_file.remove()
+    stats = EvaluationStats()
+    completed = set()
+    for result in results_file.read():
+        stats.update(result)
+        completed.add(result.game_id)
+    return results_file, stats, completed
+
+
+def next_game_ids(completed, num_games):
+    game_ids = []
+    game_id = 0
+    while len(game_ids) < num_games:
+        if game_id not in completed:
+            game_ids.append(game_id)
+        game_id += 1
+    return game_ids
+
+
+def main():
+    checkpoints = find_checkpoints()
+    print(f"Found {len(checkpoints)} checkpoints in {league_model_dir}")
+    if len(checkpoints) < 2:
+        return
+    pairs = list(itertools.combinations(range(len(checkpoints)), 2))
+    results_files = {}
+    pair_stats = {}
+    completed = {}
+    for i, j in pairs:
+        results_files[(i, j)], pair_stats[(i, j)], completed[(i, j)] = load_pair(checkpoints, i, j)
+    cached_games = sum(stats.n for stats in pair_stats.values())
+    print(f"Reusing {cached_games} cached games from {league_results_dir}")
+
+    indices = {checkpoint: index for index, checkpoint in enumerate(checkpoints)}
+    start = time.perf_counter()
+    played = 0
+    ratings = fit_ratings(len(checkpoints), pair_stats)
+    with make_pool(num_workers) as pool:
+        while played < max_league_games:
+            priorities = []
+            for i, j in pairs:
+                priority, stderr = pair_priority(pair_stats[(i, j)], ratings, i, j)
+                if stderr > target_stderr:
+                    priorities.append((priority, i, j))
+            if len(priorities) == 0:
+                break
+            priorities.sort(reverse=True)
+            scheduled = [(i, j) for _, i, j in priorities[:pairs_per_round]]
+            tasks = []
+            for i, j in scheduled:
+                for game_id in next_game_ids(completed[(i, j)], games_per_round):
+                    tasks.append((game_id, checkpoints[i], checkpoints[j], True))
+            # Only the files of this round's pairs are open, and unplayed pairs never get one
+            for pair in scheduled:
+                results_files[pair].open()
+            try:
+                for (game_id, filename, filename_opponent, _), result in play_games(pool, tasks):
+                    pair = (indices[filename], indices[filename_opponent])
+                    results_files[pair].append(result)
+                    pair_stats[pair].update(result)
+                    completed[pair].add(game_id)
+                    played += 1
+            finally:
+                for pair in scheduled:
+                    results_files[pair].close()
+            ratings = fit_ratings(len(checkpoints), pair_stats)
+            print(f"{played} games, {played / (time.perf_counter() - start):.1f} games/s, "
+                  f"{len(priorities)} pairs above target stderr")
+
+    games = np.zeros(len(checkpoints), dtype=int)
+    for (i, j), stats in pair_stats.items():
+        games[i] += stats.n
+        games[j] += stats.n
+    print("Rank  Elo     Games  Checkpoint")
+    for rank, index in enumerate(np.argsort(-ratings)):
+        print(f"{rank + 1:<5} {ratings[index]:<7.1f} {games[index]:<6} {os.path.basename(checkpoints[index])}")
+
+
+if __name__ == "__main__":
+    main()
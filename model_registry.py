@@ -0,0 +1,77 @@
+import os
+import time
+from collections import OrderedDict
+
+import torch
+from botbowl.ai.env import BotBowlEnv, EnvConf
+
+max_policies = 8
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of eval-mode policies keyed by path, file mtime and device, and of BotBowlEnv observation
+    builders keyed by env size and pathfinding. Agents only read the policies and set env.game before every use,
+    so all agents of a process can share them. The policies are an LRU of at most max_policies entries.
+    """
+    def __init__(self, max_policies=max_policies):
+        self.max_policies = max_policies
+        self.policies = OrderedDict()
+        self.envs = {}
+        self.loads = 0
+        self.hits = 0
+        self.load_time = 0.0
+        self.env_builds = 0
+        self.env_hits = 0
+
+    def get_policy(self, filename, device='cpu'):
+        device = torch.device(device)
+        key = (os.path.abspath(filename), str(device))
+        mtime = os.path.getmtime(filename)
+        if key in self.policies:
+            policy_mtime, policy = self.policies[key]
+            if policy_mtime == mtime:
+                self.hits += 1
+                self.policies.move_to_end(key)
+                return policy
+            # The file was rewritten; don't hold on to the old weights while loading the new ones
+            del self.policies[key], policy
+        start = time.perf_counter()
+        policy = torch.load(filename, map_location=device)
+        policy.eval()
+        self.load_time += time.perf_counter() - start
+        self.loads += 1
+        self.policies[key] = (mtime, policy)
+        if len(self.policies) > self.max_policies:
+            self.policies.popitem(last=False)
+        return policy
+
+    def release(self, filename, device='cpu'):
+        self.policies.pop((os.path.abspath(filename), str(torch.device(device))), None)
+
+    def get_env(self, env_conf: EnvConf):
+        key = (env_conf.size, env_conf.pathfinding_enabled)
+        if key in self.envs:
+            self.env_hits += 1
+            return self.envs[key]
+        self.env_builds += 1
+        env = self.envs[key] = BotBowlEnv(env_conf)
+        return env
+
+    def clear(self):
+        self.policies.clear()
+        self.envs.clear()
+
+    def get_stats(self):
+        avg_load_time = self.load_time / self.loads if self.loads > 0 else 0.0
+        return {
+            'loads': self.loads,
+            'hits': self.hits,
+            'load_time': self.load_time,
+            'time_saved': self.hits * avg_load_time,
+            'env_builds': self.env_builds,
+            'env_hits': self.env_hits
+        }
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,97 @@
+import time
+import weakref
+from collections import OrderedDict
+
+from botbowl import Game
+import botbowl.core.pathfinding as pathfinding_module
+
+
+def get_board_fingerprint(game: Game):
+    """
+    Cheap summary of everything the path finder reads from the game: player squares and states, the ball,
+    team rerolls and the number of reports so far.
+    """
+    players = tuple((player.position.x, player.position.y, player.state.up, player.state.used, player.state.moves)
+                    if player.position is not None else None
+                    for team in (game.state.home_team, game.state.away_team) for player in team.players)
+    ball_position = game.get_ball_position()
+    ball = (ball_position.x, ball_position.y) if ball_position is not None else None
+    teams = tuple((team.state.turn, team.state.rerolls, team.state.reroll_used)
+                  for team in (game.state.home_team, game.state.away_team))
+    return game.state.half, len(game.state.reports), ball, teams, players
+
+
+class PathfindingCache:
+    """
+    LRU of path finder results per game, each valid for one board fingerprint. Games are held weakly, so a worker
+    that interleaves several games keeps the entries of each of them.
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.games = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.miss_time = 0.0
+
+    def get_all_paths(self, game: Game, player, *args, **kwargs):
+        return self._get(pathfinding_module.get_all_paths, game, player, *args, **kwargs)
+
+    def get_safest_path(self, game: Game, player, position, *args, **kwargs):
+        return self._get(pathfinding_module.get_safest_path, game, player, position, *args, **kwargs)
+
+    def get_safest_path_to_endzone(self, game: Game, player, *args, **kwargs):
+        return self._get(pathfinding_module.get_safest_path_to_endzone, game, player, *args, **kwargs)
+
+    def _get(self, func, game, player, *args, **kwargs):
+        paths = self._validate(game)
+        # Players are keyed by identity; they live as long as their game, which owns these entries.
+        key = (func.__name__, id(player), args, tuple(sorted(kwargs.items())))
+        if key in paths:
+            self.hits += 1
+            paths.move_to_end(key)
+            return paths[key]
+        self.misses += 1
+        start = time.perf_counter()
+        result = func(game, player, *args, **kwargs)
+        self.miss_time += time.perf_counter() - start
+        paths[key] = result
+        if len(paths) > self.max_size:
+            paths.popitem(last=False)
+        return result
+
+    def _validate(self, game):
+        fingerprint = get_board_fingerprint(game)
+        entry = self.games.get(game)
+        if entry is None:
+            entry = self.games[game] = [fingerprint, OrderedDict()]
+        elif entry[0] != fingerprint:
+            if len(entry[1]) > 0:
+                self.invalidations += 1
+            entry[0] = fingerprint
+            entry[1].clear()
+        return entry[1]
+
+    def clear(self):
+        self.games.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.miss_time = 0.0
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        avg_miss_time = self.miss_time / self.misses if self.misses > 0 else 0.0
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'pathfinding_time': self.miss_time,
+            'time_saved': self.hits * avg_miss_time
+        }
+
+
+pathfinding_cache = PathfindingCache()
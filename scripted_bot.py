@@ -1,22 +1,68 @@
 from typing import List
 
+import numpy as np
 import botbowl
 from botbowl import Action, ActionType, Square, BBDieResult, Skill, Formation, ProcBot
-import botbowl.core.pathfinding as pathfinding_module
+from implementation.action_queue import ActionQueue
+from implementation.pathfinding_cache import pathfinding_cache, get_board_fingerprint
 import time
 import math
 from botbowl.core.pathfinding.python_pathfinding import Path
 
 
+class BlockOddsTable:
+    """
+    Block probabilities of every standing, unused player of team against each adjacent standing opponent.
+    """
+    def __init__(self, game, team):
+        self.attackers = []
+        self.defenders = []
+        odds = []
+        for attacker in team.players:
+            if attacker.position is not None and not attacker.state.used and attacker.state.up:
+                for defender in game.get_adjacent_opponents(attacker, down=False):
+                    self.attackers.append(attacker)
+                    self.defenders.append(defender)
+                    odds.append(game.get_block_probs(attacker, defender))
+        odds = np.array(odds, dtype=float).reshape(-1, 4)
+        self.p_self_up = 1 - odds[:, 0]
+        self.p_opp_down = odds[:, 1]
+        self.p_fumble_self = odds[:, 2]
+        self.p_fumble_opp = odds[:, 3]
+
+    def __len__(self):
+        return len(self.attackers)
+
+    def get_safest_block(self):
+        """
+        Index of the first block with the highest chance of staying up among the first block and those knocking
+        the opponent down at least as often as fumbling, or None if there are no blocks.
+        """
+        if len(self) == 0:
+            return None
+        eligible = self.p_opp_down >= self.p_fumble_self
+        eligible[0] = True
+        return int(np.argmax(np.where(eligible, self.p_self_up, -np.inf)))
+
+
 class CustomScriptedBot(ProcBot):
+    BLITZ_MIN_SCORE = 1.25
+
     def __init__(self, name):
         super().__init__(name)
         self.my_team = None
         self.opp_team = None
-        self.actions = []
+        self.actions = ActionQueue()
         self.last_turn = 0
         self.last_half = 0
         self.open_players = None
+        self.plan_paths = {}
+        self.assist_index = None
+        self.block_odds = None
+        self.block_odds_fingerprint = None
+        self.block_odds_game = None
+        self.blitz_paths = 0
+        self.blitz_prob_evaluations = 0
 
         self.off_formation = [
             ["-", "-", "-", "-", "-", "-", "-", "-", "-", "-", "-", "-", "-"],
@@ -99,26 +145,31 @@ class CustomScriptedBot(ProcBot):
         actions = game.state.available_actions
         if len(actions) == 1 and \
                 actions[0].action_type == ActionType.END_TURN:
-            self.actions = [Action(ActionType.END_TURN)]
+            self.actions.clear()
+            self.actions.append(Action(ActionType.END_TURN))
         while len(self.actions) > 0:
-            action = self.get_next_action()
-            if game._is_action_allowed(action):
+            action = self.actions.pop_allowed(game)
+            if action is not None:
                 return action
         self.make_plan(game)
         action = self.get_next_action()
         return action
 
     def get_next_action(self):
-        action = self.actions[0]
-        self.actions = self.actions[1:]
-        return action
+        return self.actions.popleft()
 
     def make_plan(self, game):
-        self.open_players = None
+        self.open_players = self.get_open_players(game)
+        self.plan_paths = {}
+        self.assist_index = None
         if not self.try_actions(game):
-            self.open_players = self.get_open_players(game)
-            if not self.try_actions(game):
-                self.actions.append(Action(ActionType.END_TURN))
+            self.actions.append(Action(ActionType.END_TURN))
+
+    def get_plan_paths(self, game, player, blitz=False):
+        key = (player.player_id, blitz)
+        if key not in self.plan_paths:
+            self.plan_paths[key] = pathfinding_cache.get_all_paths(game, player, blitz=blitz)
+        return self.plan_paths[key]
 
     def try_actions(self, game):
         prioritized_actions = [
@@ -148,7 +199,6 @@ class CustomScriptedBot(ProcBot):
             self.actions.clear()
             self.last_turn = turn
             self.last_half = half
-            self.actions = []
 
     def perform_fallen_players_standup(self, game):
         for player in self.my_team.players:
@@ -161,7 +211,7 @@ class CustomScriptedBot(ProcBot):
     def perform_ball_carrier_moving(self, game):
         ball_carrier = game.get_ball_carrier()
         if ball_carrier is not None and ball_carrier.team == self.my_team and not ball_carrier.state.used:
-            td_path = pathfinding_module.get_safest_path_to_endzone(game, ball_carrier, allow_team_reroll=True)
+            td_path = pathfinding_cache.get_safest_path_to_endzone(game, ball_carrier, allow_team_reroll=True)
             if td_path is not None and td_path.prob >= 0.7:
                 self.actions.append(Action(ActionType.START_MOVE, player=ball_carrier))
                 self.actions.extend(path_to_move_actions(game, ball_carrier, td_path))
@@ -174,7 +224,7 @@ class CustomScriptedBot(ProcBot):
                     return True
 
             if game.num_tackle_zones_in(ball_carrier) == 0:
-                paths = pathfinding_module.get_all_paths(game, ball_carrier)
+                paths = self.get_plan_paths(game, ball_carrier)
                 best_path = None
                 best_distance = 100
                 target_x = game.get_opp_endzone_x(self.my_team)
@@ -200,10 +250,10 @@ class CustomScriptedBot(ProcBot):
         for player in unused_teammates:
             if game.get_distance_to_endzone(player) > player.num_moves_left():
                 continue
-            td_path = pathfinding_module.get_safest_path_to_endzone(game, player, allow_team_reroll=True)
+            td_path = pathfinding_cache.get_safest_path_to_endzone(game, player, allow_team_reroll=True)
             if td_path is None:
                 continue
-            path = pathfinding_module.get_safest_path(game, game.get_ball_carrier(), player.position, allow_team_reroll=True)
+            path = pathfinding_cache.get_safest_path(game, game.get_ball_carrier(), player.position, allow_team_reroll=True)
             if path is None:
                 continue
             p_catch = game.get_catch_prob(player, handoff=True, allow_catch_reroll=True, allow_team_reroll=True)
@@ -228,7 +278,7 @@ class CustomScriptedBot(ProcBot):
             for player in self.my_team.players:
                 if player.position is not None and not player.state.used:
                     if player.position.distance(game.get_ball_position()) <= player.get_ma() + 2:
-                        path = pathfinding_module.get_safest_path(game, player, game.get_ball_position())
+                        path = pathfinding_cache.get_safest_path(game, player, game.get_ball_position())
                         if path is not None:
                             p = path.prob
                             if pickup_p is None or p > pickup_p:
@@ -247,7 +297,7 @@ class CustomScriptedBot(ProcBot):
     def get_safest_path_to_endzone(self, game, pickup_player, pickup_path):
         best_path = None
         best_distance = 100
-        paths = pathfinding_module.get_all_paths(game, pickup_player, from_position=game.get_ball_position(), num_moves_used=len(pickup_path))
+        paths = pathfinding_cache.get_all_paths(game, pickup_player, from_position=game.get_ball_position(), num_moves_used=len(pickup_path))
         target_x = game.get_opp_endzone_x(self.my_team)
         for path in paths:
             distance_to_endzone = abs(target_x - path.steps[-1].x)
@@ -270,7 +320,7 @@ class CustomScriptedBot(ProcBot):
             if player.has_skill(Skill.CATCH) and player != game.get_ball_carrier():
                 if game.get_distance_to_endzone(player) > player.num_moves_left():
                     continue
-                paths = pathfinding_module.get_all_paths(game, player)
+                paths = self.get_plan_paths(game, player)
                 best_path = None
                 best_distance = 100
                 target_x = game.get_opp_endzone_x(self.my_team)
@@ -286,33 +336,78 @@ class CustomScriptedBot(ProcBot):
 
     def perform_blitz_action(self, game):
         if game.is_blitz_available():
-            best_blitz_attacker = None
-            best_blitz_score = None
-            best_blitz_path = None
-            for blitzer in self.open_players:
-                if blitzer.position is not None and not blitzer.state.used and blitzer.has_skill(Skill.BLOCK):
-                    blitz_paths = pathfinding_module.get_all_paths(game, blitzer, blitz=True)
-                    for path in blitz_paths:
-                        defender = game.get_player_at(path.get_last_step())
-                        if defender is None:
-                            continue
-                        from_position = path.steps[-2] if len(path.steps)>1 else blitzer.position
-                        p_self, p_opp, p_fumble_self, p_fumble_opp = game.get_blitz_probs(blitzer, from_position, defender)
-                        p_self_up = path.prob * (1-p_self)
-                        p_opp = path.prob * p_opp
-                        p_fumble_opp = p_fumble_opp * path.prob
-                        if blitzer == game.get_ball_carrier():
-                            p_fumble_self = path.prob + (1 - path.prob) * p_fumble_self
-                        score = p_self_up + p_opp + p_fumble_opp - p_fumble_self
-                        if best_blitz_score is None or score > best_blitz_score:
-                            best_blitz_attacker = blitzer
-                            best_blitz_score = score
-                            best_blitz_path = path
-            if best_blitz_attacker is not None and best_blitz_score >= 1.25:
+            best_blitz_attacker, best_blitz_path, best_blitz_score = self.plan_blitz(game)
+            if best_blitz_attacker is not None and best_blitz_score >= self.BLITZ_MIN_SCORE:
                 self.actions.append(Action(ActionType.START_BLITZ, player=best_blitz_attacker))
                 self.actions.extend(path_to_move_actions(game, best_blitz_attacker, best_blitz_path))
                 return True
 
+    def plan_blitz(self, game, min_score=BLITZ_MIN_SCORE):
+        """
+        Returns the best scoring blitz as (blitzer, path, score), or Nones if no blitz scores at least min_score.
+        Paths are grouped by blitzer, target and from-square, which share the same blitz odds, and groups whose
+        optimistic score can't reach the best so far are skipped without calling get_blitz_probs.
+        """
+        ball_carrier = game.get_ball_carrier()
+        approaches = {}
+        path_index = 0
+        for blitzer in self.open_players:
+            if blitzer.position is not None and not blitzer.state.used and blitzer.has_skill(Skill.BLOCK):
+                for path in self.get_plan_paths(game, blitzer, blitz=True):
+                    defender = game.get_player_at(path.get_last_step())
+                    if defender is None:
+                        continue
+                    path_index += 1
+                    from_position = path.steps[-2] if len(path.steps) > 1 else blitzer.position
+                    key = (blitzer.player_id, defender.player_id, from_position.x, from_position.y)
+                    group = approaches.setdefault(key, (blitzer, defender, from_position, []))[3]
+                    if blitzer == ball_carrier:
+                        # The ball carrier's score can drop as path.prob grows, so every approach is kept
+                        group.append((path_index, path))
+                    elif len(group) == 0 or path.prob > group[0][1].prob:
+                        group[:] = [(path_index, path)]
+        self.blitz_paths += path_index
+
+        bounded_approaches = []
+        for blitzer, defender, from_position, group in approaches.values():
+            max_prob = max(path.prob for _, path in group)
+            if blitzer == ball_carrier:
+                bound = max_prob
+            else:
+                bound = max_prob * (3 if defender == ball_carrier else 2)
+            bounded_approaches.append((bound, blitzer, defender, from_position, group))
+        bounded_approaches.sort(key=lambda approach: -approach[0])
+
+        best_blitz_attacker = None
+        best_blitz_path = None
+        best_blitz_score = None
+        best_blitz_index = None
+        for bound, blitzer, defender, from_position, group in bounded_approaches:
+            if bound < min_score or (best_blitz_score is not None and bound < best_blitz_score):
+                break
+            self.blitz_prob_evaluations += 1
+            blitz_probs = game.get_blitz_probs(blitzer, from_position, defender)
+            for index, path in group:
+                score = self._get_blitz_score(blitzer == ball_carrier, path, *blitz_probs)
+                if best_blitz_score is None or score > best_blitz_score or \
+                        (score == best_blitz_score and index < best_blitz_index):
+                    best_blitz_attacker = blitzer
+                    best_blitz_path = path
+                    best_blitz_score = score
+                    best_blitz_index = index
+        if best_blitz_score is None or best_blitz_score < min_score:
+            return None, None, None
+        return best_blitz_attacker, best_blitz_path, best_blitz_score
+
+    @staticmethod
+    def _get_blitz_score(is_ball_carrier, path, p_self, p_opp, p_fumble_self, p_fumble_opp):
+        p_self_up = path.prob * (1-p_self)
+        p_opp = path.prob * p_opp
+        p_fumble_opp = p_fumble_opp * path.prob
+        if is_ball_carrier:
+            p_fumble_self = path.prob + (1 - path.prob) * p_fumble_self
+        return p_self_up + p_opp + p_fumble_opp - p_fumble_self
+
     def perform_caging_action(self, game):
         ball_pos = game.get_ball_position()
         cage = [
@@ -326,7 +421,7 @@ class CustomScriptedBot(ProcBot):
                 if self._is_valid_cage_position(game, cage_position):
                     for player in self.open_players:
                         if self._is_eligible_player(game, player, cage_position, cage):
-                            path = pathfinding_module.get_safest_path(game, player, cage_position)
+                            path = pathfinding_cache.get_safest_path(game, player, cage_position)
                             if self._is_safe_path(path):
                                 self._move_player_to_cage(game, player, path)
                                 return True
@@ -347,17 +442,24 @@ class CustomScriptedBot(ProcBot):
         self.actions.append(Action(ActionType.START_MOVE, player=player))
         self.actions.extend(path_to_move_actions(game, player, path))
 
-    def perform_assisting_player_moving(self, game, open_players):
-        for player in open_players:
-            assist_positions = self._find_assist_positions(game)
-            if self._try_assist_move(game, player, assist_positions):
-                return True
-
-    def _try_assist_move(self, game, player, assist_positions):
-        for path in pathfinding_module.get_all_paths(game, player):
-            if self._is_valid_assist_path(path, assist_positions):
-                self._execute_assist_move(game, player, path)
-                return True
+    def perform_assisting_player_moving(self, game):
+        assist_index = self.get_assist_index(game)
+        if not assist_index:
+            return
+        best_player = None
+        best_path = None
+        best_gain = None
+        for player in self.open_players:
+            for path in self.get_plan_paths(game, player):
+                if self._is_valid_assist_path(path, assist_index):
+                    gain = sum(assist[2] for assist in assist_index[path.get_last_step()])
+                    if best_gain is None or gain > best_gain:
+                        best_player = player
+                        best_path = path
+                        best_gain = gain
+        if best_player is not None:
+            self._execute_assist_move(game, best_player, best_path)
+            return True
 
     def _is_valid_assist_path(self, path, assist_positions):
         return path.prob >= 0.9 and path.get_last_step() in assist_positions
@@ -366,23 +468,48 @@ class CustomScriptedBot(ProcBot):
         self.actions.append(Action(ActionType.START_MOVE, player=player))
         self.actions.extend(path_to_move_actions(game, player, path))
 
+    def get_assist_index(self, game):
+        if self.assist_index is None:
+            self.assist_index = self._find_assist_positions(game)
+        return self.assist_index
+
     def _find_assist_positions(self, game):
-        assist_positions = set()
+        """
+        Maps each square an assist can be given from to the (attacker, defender, gain) blocks it would improve.
+        """
+        assist_index = {}
         for player in game.get_opp_team(self.my_team).players:
             if self._is_valid_opponent_for_assist(player):
-                self._add_assist_positions(game, player, assist_positions)
-        return assist_positions
+                self._add_assist_positions(game, player, assist_index)
+        return assist_index
 
     def _is_valid_opponent_for_assist(self, player):
         return player.position is not None and player.state.up
 
-    def _add_assist_positions(self, game, player, assist_positions):
+    def _add_assist_positions(self, game, player, assist_index):
         for opponent in game.get_adjacent_opponents(player, down=False):
             att_str, def_str = game.get_block_strengths(player, opponent)
             if def_str >= att_str:
+                gain = self._get_assist_gain(game, opponent, player)
                 for open_position in game.get_adjacent_squares(player.position, occupied=False):
                     if len(game.get_adjacent_players(open_position, team=self.opp_team, down=False)) == 1:
-                        assist_positions.add(open_position)
+                        assist_index.setdefault(open_position, []).append((opponent, player, gain))
+
+    def _get_assist_gain(self, game, attacker, defender):
+        att_str, def_str = game.get_block_strengths(attacker, defender)
+        return self._get_block_dice_score(att_str + 1, def_str) - self._get_block_dice_score(att_str, def_str)
+
+    @staticmethod
+    def _get_block_dice_score(att_str, def_str):
+        if att_str > 2 * def_str:
+            return 3
+        if att_str > def_str:
+            return 2
+        if att_str == def_str:
+            return 1
+        if 2 * att_str < def_str:
+            return -3
+        return -2
 
     def perform_towards_ball_moving(self, game):
         for player in self.open_players:
@@ -391,13 +518,13 @@ class CustomScriptedBot(ProcBot):
             shortest_distance = None
             path = None
             if game.get_ball_carrier() is None:
-                for p in pathfinding_module.get_all_paths(game, player):
+                for p in self.get_plan_paths(game, player):
                     distance = p.get_last_step().distance(game.get_ball_position())
                     if shortest_distance is None or (p.prob == 1 and distance < shortest_distance):
                         shortest_distance = distance
                         path = p
             elif game.get_ball_carrier().team != self.my_team:
-                for p in pathfinding_module.get_all_paths(game, player):
+                for p in self.get_plan_paths(game, player):
                     distance = p.get_last_step().distance(game.get_ball_carrier().position)
                     if shortest_distance is None or (p.prob == 1 and distance < shortest_distance):
                         shortest_distance = distance
@@ -414,36 +541,32 @@ class CustomScriptedBot(ProcBot):
             self.actions.append(Action(ActionType.BLOCK, position=defender.position))
             return True
 
+    def get_block_odds(self, game):
+        fingerprint = get_board_fingerprint(game)
+        # The table holds this game's players, so a fingerprint match from another game doesn't count
+        if game is not self.block_odds_game or fingerprint != self.block_odds_fingerprint:
+            self.block_odds = BlockOddsTable(game, self.my_team)
+            self.block_odds_fingerprint = fingerprint
+            self.block_odds_game = game
+        return self.block_odds
+
     def get_safest_block(self, game):
-        block_attacker = None
-        block_defender = None
-        block_p_self_up = None
-        block_p_opp_down = None
-        block_p_fumble_self = None
-        block_p_fumble_opp = None
-        for attacker in self.my_team.players:
-            if attacker.position is not None and not attacker.state.used and attacker.state.up:
-                for defender in game.get_adjacent_opponents(attacker, down=False):
-                    p_self, p_opp, p_fumble_self, p_fumble_opp = game.get_block_probs(attacker, defender)
-                    p_self_up = (1-p_self)
-                    if block_p_self_up is None or (p_self_up > block_p_self_up and p_opp >= p_fumble_self):
-                        block_p_self_up = p_self_up
-                        block_p_opp_down = p_opp
-                        block_attacker = attacker
-                        block_defender = defender
-                        block_p_fumble_self = p_fumble_self
-                        block_p_fumble_opp = p_fumble_opp
-        return block_attacker, block_defender, block_p_self_up, block_p_opp_down, block_p_fumble_self, block_p_fumble_opp
+        block_odds = self.get_block_odds(game)
+        i = block_odds.get_safest_block()
+        if i is None:
+            return None, None, None, None, None, None
+        return block_odds.attackers[i], block_odds.defenders[i], float(block_odds.p_self_up[i]), \
+            float(block_odds.p_opp_down[i]), float(block_odds.p_fumble_self[i]), float(block_odds.p_fumble_opp[i])
 
     def player_action(self, game):
         while len(self.actions) > 0:
-            action = self.get_next_action()
-            if game._is_action_allowed(action):
+            action = self.actions.pop_allowed(game)
+            if action is not None:
                 return action
 
         ball_carrier = game.get_ball_carrier()
         if ball_carrier == game.get_active_player():
-            td_path = pathfinding_module.get_safest_path_to_endzone(game, ball_carrier)
+            td_path = pathfinding_cache.get_safest_path_to_endzone(game, ball_carrier)
             if td_path is not None and td_path.prob <= 0.9:
                 self.actions.extend(path_to_move_actions(game, ball_carrier, td_path))
                 return self.get_next_action()
@@ -676,14 +799,22 @@ def main():
         game.config.fast_mode = True
 
         print("Starting game", (i+1))
+        pathfinding_cache.reset_stats()
+        home_agent.actions.reset_stats()
         start = time.time()
         game.init()
         end = time.time()
         print(end - start)
+        stats = pathfinding_cache.get_stats()
+        print(f"Pathfinding cache hits/misses: {stats['hits']}/{stats['misses']}, "
+              f"time saved: {stats['time_saved']:.2f}s of {stats['pathfinding_time']:.2f}s")
+        stats = home_agent.actions.get_stats()
+        print(f"Discarded plans: {stats['discarded_plans']}/{stats['plans']}, "
+              f"actions: {stats['discarded_actions']}/{stats['planned_actions']}")
 
         wins += 1 if game.get_winning_team() is game.state.home_team else 0
         tds += game.state.home_team.state.score
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
\ No newline at end of file